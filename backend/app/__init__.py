@@ -1,37 +1,69 @@
 import os
-from flask import Flask
-from flask_cors import CORS
 import logging
 
+# Configured before importing the app modules, some of which log (and configure logging) at import
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
+
+from flask import Flask
+from flask_cors import CORS
+from app.json_provider import ORJSONProvider
+from app.uploads import UploadRequest
+from app.http import configure_hub_http
+from app.vlm_client import get_vlm_service
+from app.trans_client import get_transcription_service
+from app.routes import bp
+from models import db, ensure_schema
+from models.model import ChatSession, ChatMessage
+
 logger = logging.getLogger(__name__)
 
+# The app holds process-wide singletons (model clients, streamer), so it is built once
+_APP = None
+
 def create_app():
+    global _APP
+    if _APP is not None:
+        return _APP
+    
     app = Flask(__name__)
+    app.json = ORJSONProvider(app)
+    # Multipart file parts are written straight into the upload folder
+    app.request_class = UploadRequest
     
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'TODO')
-    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB
+    # Larger request bodies are refused with 413 before they are read
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 16)) * 1024 * 1024
     
     # Database configuration
     db_path = os.environ.get('DATABASE_PATH', 'chat_sessions.db')
     app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Enough pooled connections for every request thread (GUNICORN_THREADS / ASGI_THREADS, default 64),
+    # so busy handlers never wait out the pool timeout and fail with a 500
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 20)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 50)),
+        'pool_timeout': 10,
+    }
     
     upload_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'uploads')
     os.makedirs(upload_dir, exist_ok=True)
     app.config['UPLOAD_FOLDER'] = upload_dir
+    # Serve /uploads/<filename> through nginx X-Accel-Redirect instead of streaming it from Python
+    app.config['USE_X_ACCEL_REDIRECT'] = os.environ.get('USE_X_ACCEL_REDIRECT', '').lower() in ('1', 'true', 'yes')
+    # nginx internal location that maps onto UPLOAD_FOLDER
+    app.config['X_ACCEL_REDIRECT_PREFIX'] = os.environ.get('X_ACCEL_REDIRECT_PREFIX', '/_uploads/').rstrip('/') + '/'
+    # Or let send_file emit X-Sendfile (Apache mod_xsendfile, lighttpd) with the file's path
+    app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
     
     # Initialize database
-    from models import db
-    from models.model import ChatSession, ChatMessage
     db.init_app(app)
     
     with app.app_context():
-        db.create_all()
-        logger.info("Database tables created/verified")
+        ensure_schema()
     
     CORS(app, 
          origins=["http://localhost:3000", "http://localhost:3001", "http://localhost:5173"],
@@ -41,22 +73,22 @@ def create_app():
          supports_credentials=True)
     
     # Initialize VLM service (but don't load model yet - user will select)
-    from app.vlm_client import get_vlm_service
     vlm_service = get_vlm_service()
     logger.info("VLM service initialized. Model selection available via frontend.")
     
-    # Load transcription service
-    from app.trans_client import get_transcription_service
+    # With gunicorn --preload this runs in the master, so workers share these processors
+    preload_ids = [m.strip() for m in os.environ.get('PRELOAD_PROCESSORS', '').split(',') if m.strip()]
+    if preload_ids:
+        vlm_service.preload_processors(preload_ids)
     
-    trans_service = get_transcription_service()
+    # Reuse pooled connections for model hub downloads
+    configure_hub_http()
     
-    if trans_service.load_model():
-        logger.info("Transcription model loaded successfully")
-    else:
-        logger.error("Failed to load transcription model")
-        logger.warning("The app will start but can't use transcription")
+    # Transcription model is loaded on first use; only fetch its weights now
+    trans_service = get_transcription_service()
+    trans_service.start_prefetch()
     
-    from app.routes import register_routes
-    register_routes(app)
+    app.register_blueprint(bp)
     
+    _APP = app
     return app 
\ No newline at end of file
@@ -0,0 +1,27 @@
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from huggingface_hub import configure_http_backend
+
+logger = logging.getLogger(__name__)
+
+def create_session() -> requests.Session:
+    """requests session with a large keep-alive pool and retries on transient errors"""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=50,
+        pool_maxsize=50,
+        max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504))
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Shared session for any other outbound HTTP
+SESSION = create_session()
+
+def configure_hub_http():
+    # huggingface_hub keeps one session per thread, built by this factory
+    configure_http_backend(backend_factory=create_session)
+    logger.info("Configured pooled HTTP sessions for the model hub")
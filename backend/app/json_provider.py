@@ -0,0 +1,23 @@
+import orjson
+from flask.json.provider import DefaultJSONProvider
+
+# Timestamps in transcription chunks may come back as numpy values. Datetimes (naive UTC from
+# the models) are written in C as e.g. '2025-07-01T12:00:00Z'
+_DUMPS_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+                  | orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_OMIT_MICROSECONDS)
+
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson, used for jsonify and request.get_json"""
+
+    def dumps(self, obj, **kwargs):
+        # Indentation/separators options are ignored: responses are always compact
+        return orjson.dumps(obj, default=self.default, option=_DUMPS_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # jsonify bodies go out as orjson's bytes, without the str decode/encode round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=_DUMPS_OPTIONS | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
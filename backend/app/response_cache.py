@@ -0,0 +1,76 @@
+import os
+import json
+import hashlib
+import logging
+from threading import Lock
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 512))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+# Only greedy outputs are cached. The services sample at any temperature > 0 and generation is not
+# seeded, so replaying one sample would be wrong
+MAX_CACHEABLE_TEMPERATURE = 0.0
+
+_response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+_response_cache_lock = Lock()
+
+# path -> (mtime_ns, size, sha1), so a file is only hashed once per version
+_image_hashes = {}
+_image_hashes_lock = Lock()
+
+def image_content_hash(path):
+    """SHA1 of an image file, memoized on its mtime and size"""
+    st = os.stat(path)
+    with _image_hashes_lock:
+        cached = _image_hashes.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    digest = sha1.hexdigest()
+    with _image_hashes_lock:
+        _image_hashes[path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+def forget_image(path):
+    with _image_hashes_lock:
+        _image_hashes.pop(path, None)
+
+def make_cache_key(model_id, text_input, image_paths, conversation_history,
+                   max_new_tokens, temperature):
+    """Build the response cache key, or None if this request should not be cached"""
+    if temperature > MAX_CACHEABLE_TEMPERATURE:
+        return None
+    try:
+        image_hashes = tuple(image_content_hash(p) for p in image_paths or ())
+    except OSError as e:
+        logger.warning(f"Not caching response, failed to hash images: {e}")
+        return None
+    history_hash = hashlib.sha1(
+        json.dumps(conversation_history or [], sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+    return (
+        model_id,
+        hashlib.sha1(text_input.encode('utf-8')).hexdigest(),
+        image_hashes,
+        history_hash,
+        max_new_tokens,
+        round(temperature, 2),
+    )
+
+def get_cached_response(key):
+    if key is None:
+        return None
+    with _response_cache_lock:
+        return _response_cache.get(key)
+
+def cache_response(key, response):
+    if key is None:
+        return
+    with _response_cache_lock:
+        _response_cache[key] = response
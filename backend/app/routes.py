@@ -1,999 +1,1325 @@
 import os
+import re
 import uuid
 import logging
 import json
+import mimetypes
 import time
+import queue
+import hashlib
 import threading
-from collections import defaultdict
+import shutil
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, namedtuple
+from cachetools import TTLCache
+from functools import lru_cache
 from werkzeug.utils import secure_filename
-from flask import jsonify, request, current_app, Response
+from sqlalchemy.orm import raiseload
+from werkzeug.exceptions import RequestEntityTooLarge, NotFound
+from flask import Blueprint, jsonify, request, current_app, Response, make_response, send_from_directory
 from app.vlm_client import get_vlm_service
 from app.trans_client import get_transcription_service
+from app.streamer import generate_batched, VLM_BATCH_SIZE
+from app.uploads import COPY_BUFFER_SIZE, SpooledUpload, save_file, create_upload_file, publish_upload_file, discard_upload_file
+from app.response_cache import make_cache_key, get_cached_response, cache_response, image_content_hash, forget_image
 from models import db
+from utils.common import prepare_image, prepared_image_path
 from models.model import ChatSession, ChatMessage
 
 logger = logging.getLogger(__name__)
 
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
-ALLOWED_AUDIO_EXTENSIONS = {'mp3', 'wav', 'flac', 'ogg', 'm4a', 'aac', 'mp4', 'mov', 'avi', 'mkv'}
+ALLOWED_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'})
+ALLOWED_AUDIO_EXTENSIONS = frozenset({'mp3', 'wav', 'flac', 'ogg', 'm4a', 'aac', 'mp4', 'mov', 'avi', 'mkv'})
+# Extensions that are also ffmpeg demuxer names and decode from a pipe without seeking
+_PIPEABLE_AUDIO_FORMATS = frozenset({'mp3', 'wav', 'flac', 'ogg', 'aac'})
 
-# In-memory cache for request deduplication (hash -> timestamp)
-_request_cache = {}
-_cache_lock = threading.Lock()
-
-def _cleanup_request_cache():
-    """Remove old entries from request cache"""
-    current_time = time.time()
-    with _cache_lock:
-        keys_to_remove = [
-            key for key, timestamp in _request_cache.items()
-            if current_time - timestamp > 60  # Remove entries older than 60 seconds
-        ]
-        for key in keys_to_remove:
-            del _request_cache[key]
+# In-memory cache for request deduplication: hashes seen in the last 10 seconds, split into shards
+# with their own locks so concurrent requests rarely wait on each other. TTLCache expires entries
+# lazily and evicts the oldest beyond maxsize (10k in total), so no sweep is needed
+_REQUEST_CACHE_SHARDS = 16  # power of two, shard = hash & (shards - 1)
+_REQUEST_CACHE_TTL = 10
+_request_cache_shards = [
+    (TTLCache(maxsize=10000 // _REQUEST_CACHE_SHARDS, ttl=_REQUEST_CACHE_TTL, timer=time.monotonic), threading.Lock())
+    for _ in range(_REQUEST_CACHE_SHARDS)
+]
 
 def _is_duplicate_request(content_hash):
     """Check if this request is a duplicate within the last 10 seconds"""
-    current_time = time.time()
-    with _cache_lock:
-        if content_hash in _request_cache:
-            if current_time - _request_cache[content_hash] < 10:  # 10 second window
-                return True
+    cache, lock = _request_cache_shards[hash(content_hash) & (_REQUEST_CACHE_SHARDS - 1)]
+    with lock:
+        if content_hash in cache:
+            return True
+        cache[content_hash] = True
+        return False
+
+# Separator line around logged assistant messages
+_LOG_RULE = "=" * 80
+
+# Assistant messages being stored right now, by (session_id, message_id) -> Event set when done.
+# A retry of the same message arriving meanwhile waits on the first request instead of hitting the DB
+_INFLIGHT_WAIT_TIMEOUT = 10
+_inflight_messages = {}
+_inflight_messages_lock = threading.Lock()
+
+class _Flight:
+    """An assistant message being stored: done is set when the first request finishes, failed if it raised"""
+    __slots__ = ('done', 'failed')
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.failed = False
+
+def _begin_flight(key):
+    """Mark key as in flight. Returns None if the caller should do the work, else the leader's _Flight to wait on"""
+    with _inflight_messages_lock:
+        leader = _inflight_messages.get(key)
+        if leader is None:
+            _inflight_messages[key] = _Flight()
+        return leader
+
+def _end_flight(key, failed):
+    with _inflight_messages_lock:
+        flight = _inflight_messages.pop(key)
+    flight.failed = failed
+    flight.done.set()
+
+# Session ids recently found to exist (id -> expires_at), so /generate doesn't query for the
+# session on every call. Only hits are cached, so new sessions are seen at once; deleting a
+# session drops its entry (other worker processes may still accept it for up to the TTL)
+_SESSION_EXISTS_TTL = 60.0
+_SESSION_EXISTS_MAX_ENTRIES = 10000
+_known_sessions = {}
+
+def _session_exists(session_id):
+    now = time.monotonic()
+    expires_at = _known_sessions.get(session_id)
+    if expires_at is not None and now < expires_at:
+        return True
+    if db.session.query(ChatSession.id).filter_by(id=session_id).first() is None:
+        _known_sessions.pop(session_id, None)
+        return False
+    if len(_known_sessions) >= _SESSION_EXISTS_MAX_ENTRIES:
+        _known_sessions.clear()
+    _known_sessions[session_id] = now + _SESSION_EXISTS_TTL
+    return True
+
+# Writes the files of a multi-file upload in parallel
+_upload_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix='upload')
+BULK_HEADER_MAX_SIZE = 64 * 1024
+# Browser cache lifetime for /uploads/<filename>; stored names are never reused for other content
+UPLOAD_MAX_AGE = int(os.environ.get('UPLOAD_MAX_AGE', 3600))
+
+def _save_upload(stream, upload_folder, ext, size=None, expected_sha256=None):
+    """
+    Write an upload under its content hash, so identical images are stored once.
+    Reads the stream to EOF, or exactly size bytes when size is given.
+    Returns (saved_name, is_new); is_new is False when the same bytes were already uploaded.
+    """
+    if isinstance(stream, SpooledUpload):
+        # Already written and hashed while the form was parsed
+        saved_name = stream.hexdigest() + ext
+        final_path = os.path.join(upload_folder, saved_name)
+        if os.path.exists(final_path):
+            stream.discard()
+            return saved_name, False
+        stream.claim(final_path)
+        return saved_name, True
+    
+    sha256 = hashlib.sha256()
+    dst, tmp_path = create_upload_file(upload_folder)
+    try:
+        remaining = size
+        while remaining is None or remaining > 0:
+            chunk_size = COPY_BUFFER_SIZE if remaining is None else min(remaining, COPY_BUFFER_SIZE)
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            dst.write(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+        
+        if remaining:
+            raise ValueError(f"Upload truncated: {remaining} bytes missing")
+        digest = sha256.hexdigest()
+        if expected_sha256 and expected_sha256.lower() != digest:
+            raise ValueError("Upload checksum mismatch")
         
-        _request_cache[content_hash] = current_time
+        saved_name = digest + ext
+        final_path = os.path.join(upload_folder, saved_name)
+        if os.path.exists(final_path):
+            discard_upload_file(dst, tmp_path)
+            return saved_name, False
+        publish_upload_file(dst, tmp_path, final_path)
+        return saved_name, True
+    except BaseException:
+        discard_upload_file(dst, tmp_path)
+        raise
+
+def _after_upload(upload_folder, saved_name, is_new):
+    if is_new:
+        _invalidate_upload_listing()
+        filepath = os.path.join(upload_folder, saved_name)
+        # Generation uses the original until the downsized copy is ready
+        _upload_pool.submit(prepare_image, filepath)
+        # Warm the content hash used for response cache keys
+        _upload_pool.submit(image_content_hash, filepath)
+        logger.info("File uploaded: %s", saved_name)
+    else:
+        logger.info("File already uploaded: %s", saved_name)
+
+def _save_image_upload(file, ext):
+    """Save one multipart image on an _upload_pool thread. Returns (secure original name, saved_name, is_new)"""
+    saved_name, is_new = _save_upload(file.stream, _upload_folder, ext)
+    return secure_filename(file.filename), saved_name, is_new
+
+def _save_audio_upload(file, ext):
+    # The random name is safe on its own; the original is only echoed back
+    filename = secure_filename(file.filename)
+    unique_filename = f"{uuid.uuid4().hex}.{ext}"
+    sha256 = save_file(file, _upload_prefix + unique_filename)
+    logger.info("Audio file uploaded: %s", unique_filename)
+    return {
+        'original_name': filename,
+        'saved_name': unique_filename,
+        'path': unique_filename,  # Return relative path for API use
+        'sha256': sha256
+    }
+
+# Admission control for generation. The default lets one full batch be in flight;
+# requests beyond that wait up to GEN_ADMISSION_TIMEOUT seconds, then get a 503
+MAX_CONCURRENT_GEN = int(os.environ.get('MAX_CONCURRENT_GEN', VLM_BATCH_SIZE))
+GEN_ADMISSION_TIMEOUT = float(os.environ.get('GEN_ADMISSION_TIMEOUT', 30))
+_gen_semaphore = threading.BoundedSemaphore(MAX_CONCURRENT_GEN)
+
+# Tokens are sent in batches (one SSE frame per batch) rather than one frame per token
+STREAM_BATCH_TOKENS = 8
+STREAM_BATCH_DELAY = 0.03
+
+# Names in the upload folder, from one directory scan reused for _UPLOAD_LISTING_TTL seconds.
+# Uploads and deletes drop it so changes are seen immediately
+_UPLOAD_LISTING_TTL = 1.0
+# Folders with more entries than this are not kept as a set; each name is checked with a stat instead
+_UPLOAD_LISTING_MAX = 10000
+_upload_listing = (0.0, None, frozenset())  # (expires_at, folder, names)
+_upload_listing_lock = threading.Lock()
+
+def _invalidate_upload_listing():
+    global _upload_listing
+    _upload_listing = (0.0, None, frozenset())
+
+def _upload_names(upload_folder):
+    """The set of names in upload_folder, or None when it holds more than _UPLOAD_LISTING_MAX entries"""
+    global _upload_listing
+    expires_at, folder, names = _upload_listing
+    now = time.monotonic()
+    if now < expires_at and folder == upload_folder:
+        return names
+    with _upload_listing_lock:
+        expires_at, folder, names = _upload_listing
+        if now < expires_at and folder == upload_folder:
+            return names
+        with os.scandir(upload_folder) as entries:
+            names = frozenset(entry.name for entry in entries)
+        if len(names) > _UPLOAD_LISTING_MAX:
+            names = None
+        _upload_listing = (now + _UPLOAD_LISTING_TTL, upload_folder, names)
+        return names
+
+def _upload_exists(name, upload_folder, names):
+    """Whether name is a file directly in upload_folder, given names from _upload_names"""
+    if names is not None:
+        return name in names
+    # Only plain file names, so '../x' or 'a/b' never match
+    if not name or name in ('.', '..') or os.sep in name or (os.altsep and os.altsep in name):
         return False
+    return os.path.isfile(os.path.join(upload_folder, name))
+
+def _validate_image_paths(image_paths, upload_folder):
+    """Return the full paths of the uploaded images that exist, in request order"""
+    names = _upload_names(upload_folder)
+    prefix = os.path.join(upload_folder, '')
+    validated_paths = []
+    append = validated_paths.append
+    for path in image_paths:
+        # Only plain file names in the upload folder match, so '../x' or 'a/b' never validate
+        if _upload_exists(path, upload_folder, names):
+            append(prefix + path)
+        else:
+            logger.warning("Image not found: %s", path)
+    return validated_paths
+
+# Deletes are done by a background thread so slow disks don't hold up request threads
+_DELETE_QUEUE_SIZE = 1024
+_delete_queue = queue.Queue(maxsize=_DELETE_QUEUE_SIZE)
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+        _invalidate_upload_listing()
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Error deleting file {path}: {e}")
+
+def _drain_delete_queue():
+    while True:
+        _remove_file(_delete_queue.get())
+        _delete_queue.task_done()
+
+# Process the drain thread was started in. Started on first use, like the VLM streamer, so that with
+# gunicorn's preload_app the thread runs in the worker rather than in the master that forks it
+_delete_thread_pid = None
+_delete_thread_lock = threading.Lock()
+
+def _ensure_delete_thread():
+    global _delete_thread_pid
+    pid = os.getpid()
+    if _delete_thread_pid == pid:
+        return
+    with _delete_thread_lock:
+        if _delete_thread_pid != pid:
+            threading.Thread(target=_drain_delete_queue, name='file-delete', daemon=True).start()
+            _delete_thread_pid = pid
+
+def _delete_later(path):
+    _ensure_delete_thread()
+    try:
+        _delete_queue.put_nowait(path)
+    except queue.Full:
+        logger.warning(f"Delete queue full, deleting {path} inline")
+        _remove_file(path)
+
+def _get_json_body():
+    """
+    The request's JSON object decoded once with orjson straight from the body bytes,
+    or {} when the body is not JSON (mirrors request.get_json(silent=True) or {})
+    """
+    if not request.is_json:
+        return {}
+    try:
+        data = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+@lru_cache(maxsize=256)
+def _error_body(message):
+    return orjson.dumps({'status': 'error', 'message': message}, option=orjson.OPT_APPEND_NEWLINE)
+
+def _error(message, status):
+    """
+    JSON error response ({'status': 'error', 'message': ...}). The encoded body is cached per
+    message, but the Response is built per request since hooks (CORS) add headers to it.
+    """
+    return Response(_error_body(message), status=status, mimetype='application/json')
+
+def _sse_frame(event):
+    """One server-sent event carrying event as JSON, encoded straight to bytes"""
+    return b'data: ' + orjson.dumps(event) + b'\n\n'
+
+_SSE_DONE = _sse_frame({'type': 'done'})
+
+def _loader_options(*eager_loads):
+    """
+    Query options for the given eager loads. In debug mode every other relationship is set to
+    raise on access, so a lazy load slipping into a serializer fails loudly instead of adding a query per row
+    """
+    if current_app.debug:
+        return (*eager_loads, raiseload('*'))
+    return eager_loads
+
+def _generation_params(data):
+    """Read max_new_tokens/temperature from a request body, coerced to int/float (raises ValueError/TypeError)"""
+    return int(data.get('max_new_tokens', 512)), float(data.get('temperature', 0.7))
+
+def _extension(filename, allowed):
+    """Lowercased extension of filename if it is one of allowed, else None"""
+    _, dot, ext = filename.rpartition('.')
+    ext = ext.lower()
+    return ext if dot and ext in allowed else None
+
+def image_extension(filename):
+    """Lowercased extension of an allowed image file name, or None"""
+    return _extension(filename, ALLOWED_EXTENSIONS)
 
 def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return _extension(filename, ALLOWED_EXTENSIONS) is not None
+
+def audio_extension(filename):
+    """Lowercased extension of an allowed audio file name, or None"""
+    return _extension(filename, ALLOWED_AUDIO_EXTENSIONS)
 
 def allowed_audio_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_AUDIO_EXTENSIONS
+    return _extension(filename, ALLOWED_AUDIO_EXTENSIONS) is not None
 
-def register_routes(app):
-    @app.route('/health', methods=['GET'])
-    def health_check():
-        vlm_service = get_vlm_service()
-        vlm_model_info = vlm_service.get_model_info()
-        
-        trans_service = get_transcription_service()
-        trans_model_info = trans_service.get_model_info()
-        
-        return jsonify({
-            'status': 'healthy',
-            'service': 'qwen-omni-vlm-backend',
-            'vlm_model_loaded': vlm_service.is_loaded(),
-            'vlm_model_info': vlm_model_info,
-            'transcription_model_loaded': trans_service.is_loaded(),
-            'transcription_model_info': trans_model_info
-        })
+bp = Blueprint('api', __name__)
+
+# Process-wide singletons, bound once instead of looked up in every handler
+vlm_service = get_vlm_service()
+trans_service = get_transcription_service()
+
+# UPLOAD_FOLDER as a plain string and as a path prefix, bound once at registration so
+# handlers skip the config lookup and os.path.join for every file name
+_upload_folder = None
+_upload_prefix = None
+# Other config read on every request, bound the same way. _x_accel_prefix is None
+# unless USE_X_ACCEL_REDIRECT is set
+_max_content_length = None
+_x_accel_prefix = None
+
+@bp.record_once
+def _bind_upload_folder(state):
+    global _upload_folder, _upload_prefix, _max_content_length, _x_accel_prefix
+    config = state.app.config
+    _upload_folder = config['UPLOAD_FOLDER']
+    _upload_prefix = os.path.join(_upload_folder, '')
+    _max_content_length = config['MAX_CONTENT_LENGTH']
+    _x_accel_prefix = config['X_ACCEL_REDIRECT_PREFIX'] if config['USE_X_ACCEL_REDIRECT'] else None
+
+@bp.before_request
+def reject_oversized_body():
+    # Checked from the Content-Length header, before a handler loads a model or reads any bytes
+    # (werkzeug only enforces MAX_CONTENT_LENGTH once the body is parsed, inside the handlers' try blocks)
+    if _max_content_length is not None and (request.content_length or 0) > _max_content_length:
+        raise RequestEntityTooLarge()
+
+@bp.app_errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return _error(f'Upload too large (limit {current_app.config["MAX_CONTENT_LENGTH"] // (1024 * 1024)}MB)', 413)
+
+@bp.route('/health', methods=['GET'])
+def health_check():
+    vlm_model_info = vlm_service.get_model_info()
+    trans_model_info = trans_service.get_model_info()
     
-    @app.route('/', methods=['GET'])
-    def index():
+    return jsonify({
+        'status': 'healthy',
+        'service': 'qwen-omni-vlm-backend',
+        'vlm_model_loaded': vlm_service.is_loaded(),
+        'vlm_model_info': vlm_model_info,
+        'transcription_model_loaded': trans_service.is_loaded(),
+        'transcription_model_info': trans_model_info
+    })
+
+# The index payload never changes, so it is encoded once; the Response itself is still
+# built per request because after_request hooks (CORS) add headers to it
+_INDEX_BODY = orjson.dumps({
+    'message': 'VLM Chatbot Backend API',
+    'version': '1.0.0',
+    'endpoints': {
+        'health': '/health',
+        'model_info': '/model/info',
+        'available_models': '/model/available',
+        'switch_model': '/model/switch',
+        'generate': '/generate',
+        'upload': '/upload',
+        'transcription_model_info': '/transcription/model/info',
+        'transcription_model_reload': '/transcription/model/reload',
+        'upload_audio': '/transcription/upload',
+        'transcribe': '/transcription/transcribe',
+        'upload_and_transcribe': '/transcription/upload_and_transcribe',
+        'log_assistant_message': '/log/assistant_message',
+        'create_session': '/sessions',
+        'list_sessions': '/sessions',
+        'get_session': '/sessions/{session_id}',
+        'delete_session': '/sessions/{session_id}'
+    }
+}, option=orjson.OPT_APPEND_NEWLINE)
+
+@bp.route('/', methods=['GET'])
+def index():
+    return Response(_INDEX_BODY, mimetype='application/json')
+
+@bp.route('/model/available', methods=['GET'])
+def get_available_models():
+    """Get list of available models and current status"""
+    try:
+        available_models = vlm_service.get_available_models()
+        current_model_id = vlm_service.get_current_model_id()
+        
         return jsonify({
-            'message': 'VLM Chatbot Backend API',
-            'version': '1.0.0',
-            'endpoints': {
-                'health': '/health',
-                'model_info': '/model/info',
-                'available_models': '/model/available',
-                'switch_model': '/model/switch',
-                'generate': '/generate',
-                'upload': '/upload',
-                'transcription_model_info': '/transcription/model/info',
-                'transcription_model_reload': '/transcription/model/reload',
-                'upload_audio': '/transcription/upload',
-                'transcribe': '/transcription/transcribe',
-                'upload_and_transcribe': '/transcription/upload_and_transcribe',
-                'log_assistant_message': '/log/assistant_message',
-                'create_session': '/sessions',
-                'list_sessions': '/sessions',
-                'get_session': '/sessions/{session_id}',
-                'delete_session': '/sessions/{session_id}'
-            }
+            'status': 'success',
+            'available_models': available_models,
+            'current_model_id': current_model_id,
+            'is_task_running': False  # For compatibility with frontend
         })
-    
-    @app.route('/model/available', methods=['GET'])
-    def get_available_models():
-        """Get list of available models and current status"""
-        try:
-            vlm_service = get_vlm_service()
-            available_models = vlm_service.get_available_models()
-            current_model_id = vlm_service.get_current_model_id()
-            
+        
+    except Exception as e:
+        logger.error(f"Error getting available models: {e}")
+        return _error(str(e), 500)
+
+@bp.route('/model/switch', methods=['POST'])
+def switch_model():
+    """Load a specific model (only if no model is currently loaded)"""
+    try:
+        data = request.json
+        if not data or 'model_id' not in data:
+            return _error('model_id is required', 400)
+        
+        model_id = data['model_id']
+        
+        # Check if a model is already loaded
+        if vlm_service.is_loaded():
+            return _error(f'Model {vlm_service.get_current_model_id()} is already loaded. Cannot switch models in this session. Please restart the backend to load a different model.', 400)
+        
+        # Try to load the requested model
+        if vlm_service.load_model(model_id):
             return jsonify({
                 'status': 'success',
-                'available_models': available_models,
-                'current_model_id': current_model_id,
-                'is_task_running': False  # For compatibility with frontend
+                'message': f'Model {model_id} loaded successfully',
+                'current_model_id': model_id
             })
+        else:
+            return _error(f'Failed to load model {model_id}', 500)
             
-        except Exception as e:
-            logger.error(f"Error getting available models: {e}")
+    except Exception as e:
+        logger.error(f"Error switching model: {e}")
+        return _error(str(e), 500)
+
+@bp.route('/model/info', methods=['GET'])
+def model_info():
+    return jsonify(vlm_service.get_model_info())
+
+@bp.route('/model/reload', methods=['POST'])
+def reload_model():
+    try:
+        current_model_id = vlm_service.get_current_model_id()
+        
+        if not current_model_id:
+            return _error('No model is currently loaded', 400)
+        
+        vlm_service.unload_model()
+        
+        if vlm_service.load_model(current_model_id):
             return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
-    
-    @app.route('/model/switch', methods=['POST'])
-    def switch_model():
-        """Load a specific model (only if no model is currently loaded)"""
-        try:
-            data = request.json
-            if not data or 'model_id' not in data:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'model_id is required'
-                }), 400
-            
-            model_id = data['model_id']
-            vlm_service = get_vlm_service()
-            
-            # Check if a model is already loaded
-            if vlm_service.is_loaded():
-                return jsonify({
-                    'status': 'error',
-                    'message': f'Model {vlm_service.get_current_model_id()} is already loaded. Cannot switch models in this session. Please restart the backend to load a different model.'
-                }), 400
+                'status': 'success',
+                'message': 'Model reloaded successfully'
+            })
+        else:
+            return _error('Failed to reload model', 500)
             
-            # Try to load the requested model
-            if vlm_service.load_model(model_id):
-                return jsonify({
-                    'status': 'success',
-                    'message': f'Model {model_id} loaded successfully',
-                    'current_model_id': model_id
-                })
-            else:
-                return jsonify({
-                    'status': 'error',
-                    'message': f'Failed to load model {model_id}'
-                }), 500
-                
-        except Exception as e:
-            logger.error(f"Error switching model: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
+    except Exception as e:
+        logger.error(f"Error reloading model: {e}")
+        return _error(str(e), 500)
+
+# Validated body of a /generate or /generate/stream request
+GenerateRequest = namedtuple('GenerateRequest', 'session_id text_input max_new_tokens temperature image_paths validated_paths')
+
+def _prepare_generate():
+    """
+    Validate the current /generate or /generate/stream request: loaded model, session, text and
+    generation parameters. Returns (GenerateRequest, None), or (None, error response)
+    """
+    if not vlm_service.is_loaded():
+        return None, _error('No VLM model loaded. Please select and load a model first.', 503)
     
-    @app.route('/model/info', methods=['GET'])
-    def model_info():
-        vlm_service = get_vlm_service()
-        return jsonify(vlm_service.get_model_info())
+    data = _get_json_body()
     
-    @app.route('/model/reload', methods=['POST'])
-    def reload_model():
-        try:
-            vlm_service = get_vlm_service()
-            current_model_id = vlm_service.get_current_model_id()
-            
-            if not current_model_id:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'No model is currently loaded'
-                }), 400
-            
-            vlm_service.unload_model()
-            
-            if vlm_service.load_model(current_model_id):
-                return jsonify({
-                    'status': 'success',
-                    'message': 'Model reloaded successfully'
-                })
-            else:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Failed to reload model'
-                }), 500
-                
-        except Exception as e:
-            logger.error(f"Error reloading model: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
+    session_id = (data.get('session_id') or '').strip()
+    if not session_id:
+        return None, _error('Session ID is required', 400)
+    if not _session_exists(session_id):
+        return None, _error('Session not found', 404)
     
-    @app.route('/generate', methods=['POST'])
-    def generate_response():
-        try:
-            vlm_service = get_vlm_service()
-            
-            if not vlm_service.is_loaded():
-                return jsonify({
-                    'status': 'error',
-                    'message': 'No VLM model loaded. Please select and load a model first.'
-                }), 503
-            
-            # Get and validate session_id
-            session_id = request.json.get('session_id', '').strip()
-            if not session_id:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Session ID is required'
-                }), 400
-            
-            # Verify session exists
-            session = ChatSession.query.filter_by(id=session_id).first()
-            if not session:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Session not found'
-                }), 404
-            
-            # Get text input
-            text_input = request.json.get('text', '').strip()
-            if not text_input:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Text input is required'
-                }), 400
-            
-            # Get optional parameters
-            max_new_tokens = request.json.get('max_new_tokens', 512)
-            temperature = request.json.get('temperature', 0.7)
-            image_paths = request.json.get('image_paths', [])
-            
-            # Validate image paths
-            validated_paths = []
-            for path in image_paths:
-                full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], path)
-                if os.path.exists(full_path):
-                    validated_paths.append(full_path)
-                else:
-                    logger.warning(f"Image not found: {path}")
-            
-            # Retrieve conversation history for context
-            conversation_history = ChatMessage.get_conversation_history(session_id, limit_pairs=5, exclude_latest_user=False)
-            logger.info(f"Retrieved {len(conversation_history)} conversation pairs for context")
-            
-            # Generate response
-            response = vlm_service.generate_response(
-                text_input=text_input,
-                image_paths=validated_paths if validated_paths else None,
-                conversation_history=conversation_history,
-                max_new_tokens=max_new_tokens,
-                temperature=temperature,
-                upload_folder=current_app.config['UPLOAD_FOLDER']
-            )
-            
-            return jsonify({
-                'status': 'success',
-                'response': response,
-                'text_input': text_input,
-                'images_used': len(validated_paths)
-            })
-            
-        except Exception as e:
-            logger.error(f"Error generating response: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
+    text_input = (data.get('text') or '').strip()
+    if not text_input:
+        return None, _error('Text input is required', 400)
     
-    @app.route('/generate/stream', methods=['POST'])
-    def generate_response_stream():
-        try:
-            vlm_service = get_vlm_service()
-            
-            if not vlm_service.is_loaded():
-                return jsonify({
-                    'status': 'error',
-                    'message': 'No VLM model loaded. Please select and load a model first.'
-                }), 503
-            
-            # Get and validate session_id
-            session_id = request.json.get('session_id', '').strip()
-            if not session_id:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Session ID is required'
-                }), 400
-            
-            # Verify session exists
-            session = ChatSession.query.filter_by(id=session_id).first()
-            if not session:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Session not found'
-                }), 404
-            
-            # Get text input
-            text_input = request.json.get('text', '').strip()
-            if not text_input:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Text input is required'
-                }), 400
-            
-            # Get optional parameters
-            max_new_tokens = request.json.get('max_new_tokens', 512)
-            temperature = request.json.get('temperature', 0.7)
-            image_paths = request.json.get('image_paths', [])
-            
-            # Validate image paths
-            validated_paths = []
-            for path in image_paths:
-                full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], path)
-                if os.path.exists(full_path):
-                    validated_paths.append(full_path)
-                else:
-                    logger.warning(f"Image not found: {path}")
-            
-            # Store user message in database BEFORE starting streaming
+    try:
+        max_new_tokens, temperature = _generation_params(data)
+    except (TypeError, ValueError):
+        return None, _error('max_new_tokens must be an integer and temperature a number', 400)
+    
+    image_paths = data.get('image_paths') or []
+    validated_paths = _validate_image_paths(image_paths, _upload_folder)
+    return GenerateRequest(session_id, text_input, max_new_tokens, temperature, image_paths, validated_paths), None
+
+@bp.route('/generate', methods=['POST'])
+def generate_response():
+    try:
+        gen, error = _prepare_generate()
+        if error is not None:
+            return error
+        session_id, text_input, validated_paths = gen.session_id, gen.text_input, gen.validated_paths
+        
+        # Retrieve conversation history for context
+        conversation_history = ChatMessage.get_conversation_history(session_id, limit_pairs=5, exclude_latest_user=False)
+        logger.info(f"Retrieved {len(conversation_history)} conversation pairs for context")
+        # Return the connection to the pool before waiting on the model; the loaded rows stay usable
+        db.session.close()
+        
+        cache_key = make_cache_key(vlm_service.get_current_model_id(), text_input, validated_paths,
+                                   conversation_history, gen.max_new_tokens, gen.temperature)
+        response = get_cached_response(cache_key)
+        if response is not None:
+            logger.info("Serving response from cache")
+        else:
+            if not _gen_semaphore.acquire(timeout=GEN_ADMISSION_TIMEOUT):
+                return _error('Server is busy, please retry shortly', 503)
             try:
-                user_message = ChatMessage(
-                    session_id=session_id,
-                    message_type='user',
-                    content=text_input,
-                    images=json.dumps(image_paths) if image_paths else None,
-                    images_used=len(validated_paths)
+                # Generate response, batched with concurrent /generate requests
+                response = generate_batched(
+                    text_input=text_input,
+                    image_paths=validated_paths if validated_paths else None,
+                    conversation_history=conversation_history,
+                    max_new_tokens=gen.max_new_tokens,
+                    temperature=gen.temperature,
+                    upload_folder=_upload_folder
                 )
-                # Generate and set content hash for user message too
-                user_message.content_hash = user_message.generate_content_hash()
-                db.session.add(user_message)
-                
-                # Update session timestamp
-                session.updated_at = db.func.now()
-                db.session.commit()
-                
-            except Exception as e:
-                logger.error(f"Error storing user message: {e}")
-                db.session.rollback()
-                return jsonify({
-                    'status': 'error',
-                    'message': f'Failed to store message: {str(e)}'
-                }), 500
-            
-            # Retrieve conversation history for context (after storing current user message)
-            # Exclude the latest user message since we just added it and want previous context only
-            conversation_history = ChatMessage.get_conversation_history(session_id, limit_pairs=5, exclude_latest_user=True)
-            logger.info(f"Retrieved {len(conversation_history)} conversation pairs for context")
-            
-            # Store upload folder outside the generator to avoid application context issues
-            upload_folder = current_app.config['UPLOAD_FOLDER']
-            
-            def generate():
-                try:
-                    # Send initial metadata
-                    yield f"data: {json.dumps({'type': 'start', 'text_input': text_input, 'images_used': len(validated_paths)})}\n\n"
-                    
-                    # Stream tokens
-                    for token in vlm_service.generate_response_stream(
-                        text_input=text_input,
-                        image_paths=validated_paths if validated_paths else None,
-                        conversation_history=conversation_history,
-                        max_new_tokens=max_new_tokens,
-                        temperature=temperature,
-                        upload_folder=upload_folder
-                    ):
-                        yield f"data: {json.dumps({'type': 'token', 'content': token})}\n\n"
-                    
-                    # Send completion signal
-                    yield f"data: {json.dumps({'type': 'done'})}\n\n"
-                    
-                except Exception as e:
-                    logger.error(f"Error during streaming generation: {e}")
-                    yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
-            
-            return Response(
-                generate(),
-                mimetype='text/event-stream',
-                headers={
-                    'Cache-Control': 'no-cache',
-                    'Connection': 'keep-alive',
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Headers': 'Content-Type',
-                }
-            )
-            
-        except Exception as e:
-            logger.error(f"Error setting up streaming response: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
-    
-    @app.route('/upload', methods=['POST'])
-    def upload_file():
+            finally:
+                _gen_semaphore.release()
+            cache_response(cache_key, response)
+        
+        return jsonify({
+            'status': 'success',
+            'response': response,
+            'text_input': text_input,
+            'images_used': len(validated_paths)
+        })
+        
+    except Exception as e:
+        logger.error(f"Error generating response: {e}")
+        return _error(str(e), 500)
+
+@bp.route('/generate/stream', methods=['POST'])
+def generate_response_stream():
+    holds_gen_slot = False
+    try:
+        gen, error = _prepare_generate()
+        if error is not None:
+            return error
+        session_id, text_input, validated_paths = gen.session_id, gen.text_input, gen.validated_paths
+        
+        # Wait for a generation slot before storing anything, without holding a pooled connection
+        db.session.close()
+        if not _gen_semaphore.acquire(timeout=GEN_ADMISSION_TIMEOUT):
+            return _error('Server is busy, please retry shortly', 503)
+        holds_gen_slot = True
+        
+        # Store user message in database BEFORE starting streaming
         try:
-            if 'files' not in request.files:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'No files provided'
-                }), 400
-            
-            files = request.files.getlist('files')
-            if not files or all(f.filename == '' for f in files):
-                return jsonify({
-                    'status': 'error',
-                    'message': 'No files selected'
-                }), 400
-            
-            uploaded_files = []
-            
-            for file in files:
-                if file.filename == '':
-                    continue
-                    
-                if file and allowed_file(file.filename):
-                    filename = secure_filename(file.filename)
-                    unique_filename = f"{uuid.uuid4()}_{filename}"
-                    
-                    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
-                    file.save(filepath)
-                    
-                    uploaded_files.append({
-                        'original_name': filename,
-                        'saved_name': unique_filename,
-                        'path': unique_filename  # Return relative path for API use
-                    })
-                    
-                    logger.info(f"File uploaded: {unique_filename}")
-                else:
-                    logger.warning(f"Invalid file type: {file.filename}")
+            user_message = ChatMessage(
+                session_id=session_id,
+                message_type='user',
+                content=text_input,
+                content_hash=ChatMessage.generate_content_hash(session_id, 'user', text_input),
+                images=json.dumps(gen.image_paths) if gen.image_paths else None,
+                images_used=len(validated_paths)
+            )
+            db.session.add(user_message)
             
-            if not uploaded_files:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'No valid image files uploaded'
-                }), 400
+            # Update session timestamp
+            ChatSession.query.filter_by(id=session_id).update(
+                {ChatSession.updated_at: db.func.now()}, synchronize_session=False)
+            db.session.flush()
             
-            return jsonify({
-                'status': 'success',
-                'message': f'Successfully uploaded {len(uploaded_files)} files',
-                'files': uploaded_files
-            })
+            # Read the history in the same transaction, which already sees the flushed message;
+            # exclude it since we want previous context only. One commit covers both writes
+            conversation_history = ChatMessage.get_conversation_history(session_id, limit_pairs=5, exclude_latest_user=True)
+            db.session.commit()
             
         except Exception as e:
-            logger.error(f"Error uploading files: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
-    
-    @app.route('/uploads/<filename>', methods=['GET'])
-    def get_uploaded_file(filename):
-        try:
-            filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-            if os.path.exists(filepath):
-                from flask import send_file
-                return send_file(filepath)
-            else:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'File not found'
-                }), 404
+            logger.error(f"Error storing user message: {e}")
+            db.session.rollback()
+            return _error(f'Failed to store message: {str(e)}', 500)
+        
+        logger.info(f"Retrieved {len(conversation_history)} conversation pairs for context")
+        
+        def generate():
+            try:
+                # Send initial metadata
+                yield _sse_frame({'type': 'start', 'text_input': text_input, 'images_used': len(validated_paths)})
                 
-        except Exception as e:
-            logger.error(f"Error serving file: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
-    
-    @app.route('/uploads/<filename>', methods=['DELETE'])
-    def delete_uploaded_file(filename):
-        try:
-            filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-            if os.path.exists(filepath):
-                os.remove(filepath)
-                return jsonify({
-                    'status': 'success',
-                    'message': 'File deleted successfully'
-                })
-            else:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'File not found'
-                }), 404
+                # Stream token batches; the model runs on the VLM client's own thread
+                for batch in vlm_service.generate_response_stream_batches(
+                    max_batch=STREAM_BATCH_TOKENS,
+                    max_delay=STREAM_BATCH_DELAY,
+                    text_input=text_input,
+                    image_paths=validated_paths if validated_paths else None,
+                    conversation_history=conversation_history,
+                    max_new_tokens=gen.max_new_tokens,
+                    temperature=gen.temperature,
+                    upload_folder=_upload_folder
+                ):
+                    yield _sse_frame({'type': 'tokens', 'content': batch})
                 
-        except Exception as e:
-            logger.error(f"Error deleting file: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
-    
-    # Transcription service routes
-    @app.route('/transcription/model/info', methods=['GET'])
-    def transcription_model_info():
-        trans_service = get_transcription_service()
-        return jsonify(trans_service.get_model_info())
-    
-    @app.route('/transcription/model/reload', methods=['POST'])
-    def reload_transcription_model():
-        try:
-            trans_service = get_transcription_service()
-            trans_service.unload_model()
-            
-            if trans_service.load_model():
-                return jsonify({
-                    'status': 'success',
-                    'message': 'Transcription model reloaded successfully'
-                })
-            else:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Failed to reload transcription model'
-                }), 500
+                # Send completion signal
+                yield _SSE_DONE
                 
-        except Exception as e:
-            logger.error(f"Error reloading transcription model: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
-    
-    @app.route('/transcription/upload', methods=['POST'])
-    def upload_audio_file():
-        try:
-            if 'files' not in request.files:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'No files provided'
-                }), 400
-            
-            files = request.files.getlist('files')
-            if not files or all(f.filename == '' for f in files):
-                return jsonify({
-                    'status': 'error',
-                    'message': 'No files selected'
-                }), 400
-            
-            uploaded_files = []
-            
-            for file in files:
-                if file.filename == '':
-                    continue
-                    
-                if file and allowed_audio_file(file.filename):
-                    filename = secure_filename(file.filename)
-                    unique_filename = f"{uuid.uuid4()}_{filename}"
-                    
-                    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
-                    file.save(filepath)
-                    
-                    uploaded_files.append({
-                        'original_name': filename,
-                        'saved_name': unique_filename,
-                        'path': unique_filename  # Return relative path for API use
-                    })
-                    
-                    logger.info(f"Audio file uploaded: {unique_filename}")
-                else:
-                    logger.warning(f"Invalid audio file type: {file.filename}")
-            
-            if not uploaded_files:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'No valid audio files uploaded'
-                }), 400
+            except Exception as e:
+                logger.error(f"Error during streaming generation: {e}")
+                yield _sse_frame({'type': 'error', 'message': str(e)})
+        
+        response = Response(
+            generate(),
+            mimetype='text/event-stream',
+            # Frames are already bytes; werkzeug passes them through untouched
+            direct_passthrough=True,
+            headers={
+                'Cache-Control': 'no-cache',
+                'Connection': 'keep-alive',
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Headers': 'Content-Type',
+            }
+        )
+        # The slot is held until the stream ends; close() also runs if the client goes away early
+        response.call_on_close(_gen_semaphore.release)
+        holds_gen_slot = False
+        return response
+        
+    except Exception as e:
+        logger.error(f"Error setting up streaming response: {e}")
+        return _error(str(e), 500)
+    finally:
+        if holds_gen_slot:
+            _gen_semaphore.release()
+
+@bp.route('/upload', methods=['POST'])
+def upload_file():
+    try:
+        if 'files' not in request.files:
+            return _error('No files provided', 400)
+        
+        files = request.files.getlist('files')
+        if not files or all(f.filename == '' for f in files):
+            return _error('No files selected', 400)
+        
+        to_save = []
+        
+        for file in files:
+            if file.filename == '':
+                continue
+                
+            ext = image_extension(file.filename)
+            if ext:
+                to_save.append((file, f'.{ext}'))
+            else:
+                logger.warning("Invalid file type: %s", file.filename)
+        
+        # Write all files concurrently; list() re-raises the first write error
+        saved = list(_upload_pool.map(lambda item: _save_image_upload(*item), to_save))
+        
+        original_names = []
+        saved_names = []
+        for filename, saved_name, is_new in saved:
+            _after_upload(_upload_folder, saved_name, is_new)
+            original_names.append(filename)
+            saved_names.append(saved_name)
+        
+        if not saved_names:
+            return _error('No valid image files uploaded', 400)
+        
+        # Parallel arrays rather than a dict per file; paths are relative, for API use
+        return jsonify({
+            'status': 'success',
+            'message': f'Successfully uploaded {len(saved_names)} files',
+            'count': len(saved_names),
+            'original_names': original_names,
+            'saved_names': saved_names,
+            'paths': saved_names
+        })
+        
+    except Exception as e:
+        logger.error(f"Error uploading files: {e}")
+        return _error(str(e), 500)
+
+@bp.route('/upload/bulk', methods=['POST'])
+def upload_bulk():
+    """
+    Upload many images in one streamed request body (application/x-ndjson).
+    Each file is a JSON header line {"name": ..., "size": ..., "sha256": ...}
+    followed by exactly `size` raw bytes; sha256 is optional.
+    """
+    try:
+        stream = request.stream
+        original_names = []
+        saved_names = []
+        skipped = 0
+        
+        while True:
+            header_line = stream.readline(BULK_HEADER_MAX_SIZE)
+            if not header_line:
+                break
+            if not header_line.strip():
+                continue
             
-            return jsonify({
-                'status': 'success',
-                'message': f'Successfully uploaded {len(uploaded_files)} audio files',
-                'files': uploaded_files
-            })
+            try:
+                header = json.loads(header_line)
+                name = str(header['name'])
+                size = int(header['size'])
+            except (ValueError, KeyError, TypeError):
+                return _error(f'Invalid file header after {len(saved_names)} files', 400)
+            if size < 0:
+                return _error(f'Invalid size for {name}', 400)
+            
+            filename = secure_filename(name)
+            ext = image_extension(filename)
+            if not ext:
+                logger.warning("Invalid file type: %s", name)
+                # Consume the file body to reach the next header
+                remaining = size
+                while remaining > 0:
+                    chunk = stream.read(min(remaining, COPY_BUFFER_SIZE))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                skipped += 1
+                continue
             
-        except Exception as e:
-            logger.error(f"Error uploading audio files: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
-    
-    @app.route('/transcription/transcribe', methods=['POST'])
-    def transcribe_audio():
+            try:
+                saved_name, is_new = _save_upload(stream, _upload_folder, f'.{ext}',
+                                                  size=size, expected_sha256=header.get('sha256'))
+            except ValueError as e:
+                return _error(f'{name}: {e}', 400)
+            
+            _after_upload(_upload_folder, saved_name, is_new)
+            original_names.append(filename)
+            saved_names.append(saved_name)
+        
+        if not saved_names:
+            return _error('No valid image files uploaded', 400)
+        
+        return jsonify({
+            'status': 'success',
+            'message': f'Successfully uploaded {len(saved_names)} files',
+            'count': len(saved_names),
+            'original_names': original_names,
+            'saved_names': saved_names,
+            'paths': saved_names,
+            'skipped': skipped
+        })
+        
+    except Exception as e:
+        logger.error(f"Error in bulk upload: {e}")
+        return _error(str(e), 500)
+
+@bp.route('/uploads/<filename>', methods=['GET'])
+def get_uploaded_file(filename):
+    try:
+        if _x_accel_prefix is not None:
+            if not _upload_exists(filename, _upload_folder, _upload_names(_upload_folder)):
+                return _error('File not found', 404)
+            # Let nginx send the file from disk; see the README for the matching location block
+            response = make_response('')
+            response.headers['X-Accel-Redirect'] = _x_accel_prefix + filename
+            response.headers['Content-Type'] = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            return response
+        # No separate existence check: send_from_directory raises NotFound for a missing file.
+        # Conditional GETs (If-None-Match / If-Modified-Since) get a bodiless 304
+        return send_from_directory(_upload_folder, filename, conditional=True, etag=True, max_age=UPLOAD_MAX_AGE)
+        
+    except NotFound:
+        return _error('File not found', 404)
+    except Exception as e:
+        logger.error(f"Error serving file: {e}")
+        return _error(str(e), 500)
+
+# Image uploads are stored under their sha256, so one file can be shared by several sessions
+_CONTENT_ADDRESSED_NAME = re.compile(r'[0-9a-f]{64}\.[A-Za-z0-9]+')
+
+@bp.route('/uploads/<filename>', methods=['DELETE'])
+def delete_uploaded_file(filename):
+    try:
+        # Keep shared images that stored messages (any session's history) still point at
+        if _CONTENT_ADDRESSED_NAME.fullmatch(filename) and ChatMessage.references_image(filename):
+            return _error('File is still used by stored messages', 409)
+        
+        filepath = _upload_prefix + filename
+        # One rename both checks the file exists and hides it right away; the unlink is queued
+        doomed_path = f"{filepath}.{uuid.uuid4().hex}.deleted"
         try:
-            trans_service = get_transcription_service()
-            
-            if not trans_service.is_loaded():
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Transcription model not loaded'
-                }), 503
-            
-            data = request.json
-            if not data:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'JSON data is required'
-                }), 400
-            
-            # Get audio file path
-            audio_path = data.get('audio_path', '').strip()
-            if not audio_path:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Audio path is required'
-                }), 400
-            
-            # Get optional parameters
-            return_timestamps = data.get('return_timestamps', False)
-            batch_size = data.get('batch_size', 8)
-            keep_mp3 = data.get('keep_mp3', True)
-            
-            # Construct full path
-            full_audio_path = os.path.join(current_app.config['UPLOAD_FOLDER'], audio_path)
-            
-            if not os.path.exists(full_audio_path):
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Audio file not found'
-                }), 404
-            
-            # Process the audio file
-            result = trans_service.process_audio_file(
-                input_file_path=full_audio_path,
-                output_dir=current_app.config['UPLOAD_FOLDER'],
-                return_timestamps=return_timestamps,
-                batch_size=batch_size,
-                keep_mp3=keep_mp3
-            )
+            os.rename(filepath, doomed_path)
+        except FileNotFoundError:
+            return _error('File not found', 404)
+        _invalidate_upload_listing()
+        forget_image(filepath)
+        _delete_later(doomed_path)
+        _delete_later(prepared_image_path(filepath))
+        return jsonify({
+            'status': 'success',
+            'message': 'File scheduled for deletion'
+        }), 202
             
+    except Exception as e:
+        logger.error(f"Error deleting file: {e}")
+        return _error(str(e), 500)
+
+# Transcription service routes
+@bp.route('/transcription/model/info', methods=['GET'])
+def transcription_model_info():
+    return jsonify(trans_service.get_model_info())
+
+@bp.route('/transcription/model/reload', methods=['POST'])
+def reload_transcription_model():
+    try:
+        trans_service.unload_model()
+        
+        if trans_service.load_model():
             return jsonify({
                 'status': 'success',
-                'transcription_text': result['transcription']['text'],
-                'transcription_chunks': result['transcription']['chunks'],
-                'mp3_filename': result['mp3_filename'],
-                'original_file': audio_path,
-                'return_timestamps': return_timestamps
+                'message': 'Transcription model reloaded successfully'
             })
+        else:
+            return _error('Failed to reload transcription model', 500)
             
-        except Exception as e:
-            logger.error(f"Error during transcription: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
-    
-    @app.route('/transcription/upload_and_transcribe', methods=['POST'])
-    def upload_and_transcribe():
-        """
-        Combined endpoint: upload audio file and return transcription text
-        This is the main endpoint that the frontend should use to get transcription
-        text that can be appended to chat input.
-        """
-        try:
-            trans_service = get_transcription_service()
-            
-            if not trans_service.is_loaded():
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Transcription model not loaded'
-                }), 503
-            
-            if 'file' not in request.files:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'No audio file provided'
-                }), 400
-            
-            file = request.files['file']
+    except Exception as e:
+        logger.error(f"Error reloading transcription model: {e}")
+        return _error(str(e), 500)
+
+@bp.route('/transcription/upload', methods=['POST'])
+def upload_audio_file():
+    try:
+        if 'files' not in request.files:
+            return _error('No files provided', 400)
+        
+        files = request.files.getlist('files')
+        if not files or all(f.filename == '' for f in files):
+            return _error('No files selected', 400)
+        
+        to_save = []
+        
+        for file in files:
             if file.filename == '':
-                return jsonify({
-                    'status': 'error',
-                    'message': 'No file selected'
-                }), 400
-            
-            if not file or not allowed_audio_file(file.filename):
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Invalid audio file type'
-                }), 400
-            
-            # Get optional parameters
-            return_timestamps = request.form.get('return_timestamps', 'false').lower() == 'true'
-            batch_size = int(request.form.get('batch_size', 8))
-            keep_mp3 = request.form.get('keep_mp3', 'true').lower() == 'true'
-            
-            # Save uploaded file temporarily
-            filename = secure_filename(file.filename)
-            unique_filename = f"{uuid.uuid4()}_{filename}"
-            temp_filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(temp_filepath)
+                continue
             
+            ext = audio_extension(file.filename)
+            if file and ext:
+                to_save.append((file, ext))
+            else:
+                logger.warning("Invalid audio file type: %s", file.filename)
+        
+        # Write all files concurrently; list() re-raises the first write error
+        uploaded_files = list(_upload_pool.map(lambda item: _save_audio_upload(*item), to_save))
+        
+        if not uploaded_files:
+            return _error('No valid audio files uploaded', 400)
+        
+        return jsonify({
+            'status': 'success',
+            'message': f'Successfully uploaded {len(uploaded_files)} audio files',
+            'files': uploaded_files
+        })
+        
+    except Exception as e:
+        logger.error(f"Error uploading audio files: {e}")
+        return _error(str(e), 500)
+
+@bp.route('/transcription/transcribe', methods=['POST'])
+def transcribe_audio():
+    try:
+        if not trans_service.ensure_loaded():
+            return _error('Transcription model could not be loaded', 503)
+        
+        data = request.json
+        if not data:
+            return _error('JSON data is required', 400)
+        
+        # Get audio file path
+        audio_path = data.get('audio_path', '').strip()
+        if not audio_path:
+            return _error('Audio path is required', 400)
+        
+        # Get optional parameters
+        return_timestamps = bool(data.get('return_timestamps', False))
+        batch_size = data.get('batch_size', 8)
+        keep_mp3 = data.get('keep_mp3', True)
+        
+        # Construct full path
+        full_audio_path = _upload_prefix + audio_path
+        
+        if not os.path.exists(full_audio_path):
+            return _error('Audio file not found', 404)
+        
+        # Process the audio file
+        result = trans_service.process_audio_file(
+            input_file_path=full_audio_path,
+            output_dir=_upload_folder,
+            return_timestamps=return_timestamps,
+            batch_size=batch_size,
+            keep_mp3=keep_mp3
+        )
+        
+        return jsonify({
+            'status': 'success',
+            'transcription_text': result['transcription']['text'],
+            'transcription_chunks': result['transcription']['chunks'] if return_timestamps else None,
+            'mp3_filename': result['mp3_filename'],
+            'original_file': audio_path,
+            'return_timestamps': return_timestamps
+        })
+        
+    except Exception as e:
+        logger.error(f"Error during transcription: {e}")
+        return _error(str(e), 500)
+
+@bp.route('/transcription/transcribe/stream', methods=['POST'])
+def transcribe_audio_stream():
+    """
+    Same request as /transcription/transcribe, answered as NDJSON: one line per transcribed
+    window ({"type": "chunk", "text", "chunks", "start", "end"}) as soon as it is ready,
+    then {"type": "done", ...} (or {"type": "error", "message"})
+    """
+    try:
+        if not trans_service.ensure_loaded():
+            return _error('Transcription model could not be loaded', 503)
+        
+        data = request.json
+        if not data:
+            return _error('JSON data is required', 400)
+        
+        audio_path = data.get('audio_path', '').strip()
+        if not audio_path:
+            return _error('Audio path is required', 400)
+        
+        return_timestamps = bool(data.get('return_timestamps', False))
+        batch_size = data.get('batch_size', 8)
+        keep_mp3 = data.get('keep_mp3', True)
+        
+        full_audio_path = _upload_prefix + audio_path
+        
+        if not os.path.exists(full_audio_path):
+            return _error('Audio file not found', 404)
+        
+        def generate():
             try:
-                # Process the audio file
-                result = trans_service.process_audio_file(
-                    input_file_path=temp_filepath,
-                    output_dir=current_app.config['UPLOAD_FOLDER'],
+                for event in trans_service.process_audio_file_stream(
+                    input_file_path=full_audio_path,
+                    output_dir=_upload_folder,
                     return_timestamps=return_timestamps,
                     batch_size=batch_size,
                     keep_mp3=keep_mp3
-                )
-                
-                # Clean up original uploaded file
-                os.remove(temp_filepath)
-                
-                return jsonify({
-                    'status': 'success',
-                    'transcription_text': result['transcription']['text'],
-                    'transcription_chunks': result['transcription']['chunks'] if return_timestamps else None,
-                    'mp3_filename': result['mp3_filename'] if keep_mp3 else None,
-                    'original_filename': filename,
-                    'return_timestamps': return_timestamps
-                })
+                ):
+                    if event['type'] == 'done':
+                        event['original_file'] = audio_path
+                        event['return_timestamps'] = return_timestamps
+                    yield orjson.dumps(event, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE)
                 
             except Exception as e:
-                # Clean up temporary file on error
-                if os.path.exists(temp_filepath):
-                    os.remove(temp_filepath)
-                raise
-            
-        except Exception as e:
-            logger.error(f"Error in upload_and_transcribe: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
-    
-    # Session management endpoints
-    @app.route('/sessions', methods=['POST'])
-    def create_session():
-        """Create a new chat session"""
-        try:
-            data = request.json
-            if not data:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'JSON data is required'
-                }), 400
-            
-            # Validate required fields
-            name = data.get('name', '').strip()
-            model_id = data.get('model_id', '').strip()
-            
-            if not name:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Session name is required'
-                }), 400
-                
-            if not model_id:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Model ID is required'
-                }), 400
-            
-            # Create new session
-            session = ChatSession(name=name, model_id=model_id)
-            db.session.add(session)
-            db.session.commit()
-            
-            logger.info(f"Created new session: {session.id} - {session.name} - {session.model_id}")
-            
-            return jsonify({
-                'status': 'success',
-                'session': session.to_dict(),
-                'message': f'Session "{name}" created successfully'
-            })
-            
-        except Exception as e:
-            db.session.rollback()
-            logger.error(f"Error creating session: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
+                logger.error(f"Error during streaming transcription: {e}")
+                yield orjson.dumps({'type': 'error', 'message': str(e)}, option=orjson.OPT_APPEND_NEWLINE)
+        
+        return Response(
+            generate(),
+            mimetype='application/x-ndjson',
+            headers={'Cache-Control': 'no-cache'}
+        )
+        
+    except Exception as e:
+        logger.error(f"Error setting up streaming transcription: {e}")
+        return _error(str(e), 500)
+
+def _transcribe_upload(source, ext, filename, options):
+    """
+    Transcribe an uploaded audio file for the upload_and_transcribe endpoints.
+    source holds input_file_path or input_stream; options is request.form or request.args.
+    """
+    return_timestamps = options.get('return_timestamps', 'false').lower() == 'true'
+    batch_size = int(options.get('batch_size', 8))
+    keep_mp3 = options.get('keep_mp3', 'true').lower() == 'true'
     
-    @app.route('/sessions', methods=['GET'])
-    def list_sessions():
-        """List all chat sessions"""
-        try:
-            sessions = ChatSession.query.order_by(ChatSession.updated_at.desc()).all()
-            return jsonify({
-                'status': 'success',
-                'sessions': [session.to_dict() for session in sessions]
-            })
-            
-        except Exception as e:
-            logger.error(f"Error listing sessions: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
+    result = trans_service.process_audio_file(
+        output_dir=_upload_folder,
+        return_timestamps=return_timestamps,
+        batch_size=batch_size,
+        keep_mp3=keep_mp3,
+        # Formats ffmpeg can only probe by seeking (mp4/mov/mkv/avi) are left to its probe
+        input_format=ext if ext in _PIPEABLE_AUDIO_FORMATS else None,
+        input_name=filename,
+        **source
+    )
     
-    @app.route('/sessions/<session_id>', methods=['GET'])
-    def get_session(session_id):
-        """Get session details with messages"""
-        try:
-            session = ChatSession.query.filter_by(id=session_id).first()
-            if not session:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Session not found'
-                }), 404
-            
-            # Get messages for this session
-            messages = ChatMessage.query.filter_by(session_id=session_id).order_by(ChatMessage.created_at.asc()).all()
+    return jsonify({
+        'status': 'success',
+        'transcription_text': result['transcription']['text'],
+        'transcription_chunks': result['transcription']['chunks'] if return_timestamps else None,
+        'mp3_filename': result['mp3_filename'] if keep_mp3 else None,
+        'original_filename': filename,
+        'return_timestamps': return_timestamps
+    })
+
+@bp.route('/transcription/upload_and_transcribe', methods=['POST'])
+def upload_and_transcribe():
+    """
+    Combined endpoint: upload audio file and return transcription text
+    This is the main endpoint that the frontend should use to get transcription
+    text that can be appended to chat input.
+    """
+    try:
+        if not trans_service.ensure_loaded():
+            return _error('Transcription model could not be loaded', 503)
+        
+        if 'file' not in request.files:
+            return _error('No audio file provided', 400)
+        
+        file = request.files['file']
+        if file.filename == '':
+            return _error('No file selected', 400)
+        
+        ext = audio_extension(file.filename)
+        if not file or not ext:
+            return _error('Invalid audio file type', 400)
+        
+        # Decode the upload where it already is instead of saving a copy first; the spooled
+        # part is removed with the request
+        if isinstance(file.stream, SpooledUpload):
+            file.stream.flush()
+            source = {'input_file_path': file.stream.path}
+        else:
+            source = {'input_stream': file.stream}
+        
+        return _transcribe_upload(source, ext, secure_filename(file.filename), request.form)
+        
+    except Exception as e:
+        logger.error(f"Error in upload_and_transcribe: {e}")
+        return _error(str(e), 500)
+
+@bp.route('/transcription/upload_and_transcribe/raw', methods=['POST'])
+def upload_and_transcribe_raw():
+    """
+    upload_and_transcribe for a raw audio request body, which skips multipart parsing:
+    the file name comes from the X-Filename header and the options from the query string
+    """
+    upload = None
+    try:
+        if not trans_service.ensure_loaded():
+            return _error('Transcription model could not be loaded', 503)
+        
+        filename = secure_filename(request.headers.get('X-Filename', ''))
+        if not filename:
+            return _error('X-Filename header is required', 400)
+        
+        ext = audio_extension(filename)
+        if not ext:
+            return _error('Invalid audio file type', 400)
+        
+        upload = SpooledUpload(_upload_folder)
+        shutil.copyfileobj(request.stream, upload, COPY_BUFFER_SIZE)
+        upload.flush()
+        
+        return _transcribe_upload({'input_file_path': upload.path}, ext, filename, request.args)
+        
+    except Exception as e:
+        logger.error(f"Error in upload_and_transcribe_raw: {e}")
+        return _error(str(e), 500)
+    finally:
+        if upload is not None:
+            upload.discard()
+
+# Session management endpoints
+@bp.route('/sessions', methods=['POST'])
+def create_session():
+    """Create a new chat session"""
+    try:
+        data = request.json
+        if not data:
+            return _error('JSON data is required', 400)
+        
+        # Validate required fields
+        name = data.get('name', '').strip()
+        model_id = data.get('model_id', '').strip()
+        
+        if not name:
+            return _error('Session name is required', 400)
             
-            return jsonify({
+        if not model_id:
+            return _error('Model ID is required', 400)
+        
+        # Create new session
+        session = ChatSession(name=name, model_id=model_id)
+        db.session.add(session)
+        db.session.commit()
+        
+        logger.info(f"Created new session: {session.id} - {session.name} - {session.model_id}")
+        
+        return jsonify({
+            'status': 'success',
+            'session': session.to_dict(),
+            'message': f'Session "{name}" created successfully'
+        })
+        
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error creating session: {e}")
+        return _error(str(e), 500)
+
+@bp.route('/sessions', methods=['GET'])
+def list_sessions():
+    """List all chat sessions"""
+    try:
+        sessions = ChatSession.query.options(*_loader_options()).order_by(ChatSession.updated_at.desc()).all()
+        return jsonify({
+            'status': 'success',
+            'sessions': [session.to_dict() for session in sessions]
+        })
+        
+    except Exception as e:
+        logger.error(f"Error listing sessions: {e}")
+        return _error(str(e), 500)
+
+@bp.route('/sessions/<session_id>', methods=['GET'])
+def get_session(session_id):
+    """Get session details with messages"""
+    try:
+        session = ChatSession.query.options(*_loader_options()).filter_by(id=session_id).first()
+        if not session:
+            return _error('Session not found', 404)
+        
+        # Every new message bumps message_count (and updated_at), so together they version the session;
+        # an unchanged session is answered with a 304 before its messages are read
+        etag = f'{session.updated_at.timestamp()}-{session.message_count}'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = jsonify({
                 'status': 'success',
                 'session': session.to_dict(),
-                'messages': [message.to_dict() for message in messages]
+                # Plain row dicts, without building a ChatMessage per row
+                'messages': ChatMessage.dicts_for_session(session_id)
             })
-            
-        except Exception as e:
-            logger.error(f"Error getting session {session_id}: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
-    
-    @app.route('/sessions/<session_id>', methods=['DELETE'])
-    def delete_session(session_id):
-        """Delete a chat session and all its messages"""
-        try:
-            session = ChatSession.query.filter_by(id=session_id).first()
-            if not session:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Session not found'
-                }), 404
-            
-            session_name = session.name
-            db.session.delete(session)
-            db.session.commit()
-            
-            logger.info(f"Deleted session: {session_id} - {session_name}")
-            
-            return jsonify({
-                'status': 'success',
-                'message': f'Session "{session_name}" deleted successfully'
-            })
-            
-        except Exception as e:
-            db.session.rollback()
-            logger.error(f"Error deleting session {session_id}: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
-
-    @app.route('/log/assistant_message', methods=['POST'])
-    def log_assistant_message():
-        """
-        Endpoint to receive and store assistant messages in database
-        after text streaming is complete
-        """
-        try:
-            data = request.json
-            if not data:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'JSON data is required'
-                }), 400
-            
-            # Get and validate session_id
-            session_id = data.get('session_id', '').strip()
-            if not session_id:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Session ID is required'
-                }), 400
-            
-            # Verify session exists
-            session = ChatSession.query.filter_by(id=session_id).first()
-            if not session:
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Session not found'
-                }), 404
-            
-            # Get message data
-            message_id = data.get('message_id', 'unknown')
-            content = data.get('content', '')
-            timestamp = data.get('timestamp', '')
-            user_input = data.get('user_input', '')
-            images_used = data.get('images_used', 0)
-            
-            if not content.strip():
-                return jsonify({
-                    'status': 'error',
-                    'message': 'Message content cannot be empty'
-                }), 400
-            
-            # First check: if we have a valid message_id, check if we've already processed it
-            if message_id != 'unknown':
-                existing_message_by_id = ChatMessage.query.filter_by(
-                    id=message_id,
-                    session_id=session_id,
-                    message_type='assistant'
-                ).first()
-                
-                if existing_message_by_id:
-                    logger.warning(f"Message with ID {message_id} already exists in session {session_id}, skipping storage")
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+        
+    except Exception as e:
+        logger.error(f"Error getting session {session_id}: {e}")
+        return _error(str(e), 500)
+
+@bp.route('/sessions/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    """Delete a chat session and all its messages"""
+    try:
+        session_name = db.session.query(ChatSession.name).filter_by(id=session_id).scalar()
+        if session_name is None:
+            return _error('Session not found', 404)
+        
+        # Two set-based DELETEs rather than an ORM cascade that loads and deletes each message in turn;
+        # messages go first, which also covers databases created before the FK had ON DELETE CASCADE
+        ChatSession.delete_with_messages(session_id)
+        db.session.commit()
+        _known_sessions.pop(session_id, None)
+        
+        logger.info(f"Deleted session: {session_id} - {session_name}")
+        
+        return jsonify({
+            'status': 'success',
+            'message': f'Session "{session_name}" deleted successfully'
+        })
+        
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error deleting session {session_id}: {e}")
+        return _error(str(e), 500)
+
+@bp.route('/log/assistant_message', methods=['POST'])
+def log_assistant_message():
+    """
+    Endpoint to receive and store assistant messages in database
+    after text streaming is complete
+    """
+    try:
+        data = request.json
+        if not data:
+            return _error('JSON data is required', 400)
+        
+        # Get and validate session_id
+        session_id = data.get('session_id', '').strip()
+        if not session_id:
+            return _error('Session ID is required', 400)
+        
+        # Verify session exists
+        if not _session_exists(session_id):
+            return _error('Session not found', 404)
+        
+        # Get message data
+        message_id = data.get('message_id', 'unknown')
+        content = data.get('content', '')
+        timestamp = data.get('timestamp', '')
+        user_input = data.get('user_input', '')
+        images_used = data.get('images_used', 0)
+        
+        if not content.strip():
+            return _error('Message content cannot be empty', 400)
+        
+        # Coalesce concurrent retries of the same message: only the first one touches the database
+        flight_key = (session_id, message_id) if message_id != 'unknown' else None
+        is_leader = True
+        if flight_key is not None:
+            leader = _begin_flight(flight_key)
+            if leader is not None:
+                is_leader = False
+                if leader.done.wait(_INFLIGHT_WAIT_TIMEOUT) and not leader.failed:
+                    logger.warning(f"Message {message_id} for session {session_id} was already being stored, skipping storage")
                     return jsonify({
                         'status': 'success',
-                        'message': 'Message already exists, skipped storage',
-                        'existing_message_id': existing_message_by_id.id
+                        'message': 'Message already being stored, skipped storage'
                     })
+                # The first request failed or is stuck; store it here, relying on the INSERT's dedup
+                logger.warning(f"Earlier request for message {message_id} in session {session_id} failed or timed out, storing it")
+        
+        leader_failed = False
+        try:
+            content_hash = ChatMessage.generate_content_hash(session_id, 'assistant', content)
             
-            # Create temporary message to generate content hash
-            temp_message = ChatMessage(
-                session_id=session_id,
-                message_type='assistant',
-                content=content
-            )
-            content_hash = temp_message.generate_content_hash()
-            
-            # Clean up old cache entries periodically
-            _cleanup_request_cache()
-            
-            # Third check: request-level deduplication using in-memory cache
-            if _is_duplicate_request(content_hash):
+            # Fast pre-filter: request-level deduplication using in-memory cache. Skipped when taking
+            # over from a failed request, which already put this hash in the cache
+            if is_leader and _is_duplicate_request(content_hash):
                 logger.warning(f"Duplicate request detected for session {session_id} (hash: {content_hash[:8]}...), skipping storage")
                 return jsonify({
                     'status': 'success',
                     'message': 'Duplicate request detected, skipped storage'
                 })
             
-            # Check for duplicate assistant messages using content hash and recent timestamp
-            # Use SELECT FOR UPDATE to prevent race conditions
-            import datetime
-            thirty_seconds_ago = datetime.datetime.utcnow() - datetime.timedelta(seconds=30)
-            
-            existing_message = ChatMessage.query.filter(
-                ChatMessage.session_id == session_id,
-                ChatMessage.message_type == 'assistant',
-                ChatMessage.content_hash == content_hash,
-                ChatMessage.created_at >= thirty_seconds_ago
-            ).with_for_update().first()
-            
-            if existing_message:
-                logger.warning(f"Duplicate assistant message detected for session {session_id} (hash: {content_hash[:8]}...), skipping storage")
-                return jsonify({
-                    'status': 'success',
-                    'message': 'Duplicate message detected, skipped storage',
-                    'duplicate_message_id': existing_message.id
-                })
-            
-            # Store assistant message in database
-            assistant_message = ChatMessage(
+            # One INSERT that skips both an already stored message_id and the same content
+            # stored for this session in the last 30 seconds
+            inserted_id = ChatMessage.insert_assistant_message(
                 session_id=session_id,
-                message_type='assistant',
                 content=content,
                 content_hash=content_hash,
                 images_used=images_used,
-                user_input=user_input
+                user_input=user_input,
+                message_id=message_id if message_id != 'unknown' and message_id.strip() else None,
+                dedup_seconds=30
             )
+            if inserted_id is None:
+                db.session.rollback()
+                logger.warning(f"Duplicate assistant message detected for session {session_id} (id: {message_id}, hash: {content_hash[:8]}...), skipping storage")
+                return jsonify({
+                    'status': 'success',
+                    'message': 'Duplicate message detected, skipped storage'
+                })
             
-            # Use the frontend message ID if available and valid
-            if message_id != 'unknown' and message_id.strip():
-                assistant_message.id = message_id
-            db.session.add(assistant_message)
-            
-            # Update session timestamp
-            session.updated_at = db.func.now()
             db.session.commit()
             
-            # Log the assistant message
-            logger.info("=" * 80)
-            logger.info("ASSISTANT MESSAGE RECEIVED")
-            logger.info("=" * 80)
-            logger.info(f"Session ID: {session_id}")
-            logger.info(f"Message ID: {message_id}")
-            logger.info(f"Timestamp: {timestamp}")
-            logger.info(f"User Input: {user_input}")
-            logger.info(f"Images Used: {images_used}")
-            logger.info("-" * 40)
-            logger.info("Assistant Response:")
-            logger.info(content)
-            logger.info("=" * 80)
+            # Log the assistant message as one record, so concurrent requests don't interleave lines
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    f"\n{_LOG_RULE}\nASSISTANT MESSAGE RECEIVED\n{_LOG_RULE}\n"
+                    f"Session ID: {session_id}\n"
+                    f"Message ID: {message_id}\n"
+                    f"Timestamp: {timestamp}\n"
+                    f"User Input: {user_input}\n"
+                    f"Images Used: {images_used}\n"
+                    f"{'-' * 40}\n"
+                    f"Assistant Response:\n"
+                    f"{content}\n"
+                    f"{_LOG_RULE}"
+                )
             
             return jsonify({
                 'status': 'success',
                 'message': 'Assistant message logged and stored successfully'
             })
-            
-        except Exception as e:
-            db.session.rollback()
-            logger.error(f"Error logging assistant message: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': str(e)
-            }), 500
-    
- 
\ No newline at end of file
+        except Exception:
+            leader_failed = True
+            raise
+        finally:
+            if flight_key is not None and is_leader:
+                _end_flight(flight_key, leader_failed)
+        
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error logging assistant message: {e}")
+        return _error(str(e), 500)
+
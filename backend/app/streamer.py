@@ -0,0 +1,52 @@
+import os
+import logging
+from threading import Lock
+from service_streamer import ManagedModel, ThreadedStreamer
+from app.vlm_client import get_vlm_service
+
+logger = logging.getLogger(__name__)
+
+# Up to VLM_BATCH_SIZE concurrent /generate requests arriving within
+# VLM_BATCH_MAX_LATENCY seconds are run as a single batched forward pass
+VLM_BATCH_SIZE = int(os.environ.get('VLM_BATCH_SIZE', 8))
+VLM_BATCH_MAX_LATENCY = float(os.environ.get('VLM_BATCH_MAX_LATENCY', 0.1))
+
+class VLMManagedModel(ManagedModel):
+    """
+    Batch predictor handed to service_streamer.
+    Each batch item is a dict of VLMClient.generate_response keyword arguments.
+    """
+
+    def init_model(self):
+        self.model = get_vlm_service()
+
+    def predict(self, batch):
+        return self.model.generate_batch(batch)
+
+
+_streamer = None
+_streamer_lock = Lock()
+
+def get_vlm_streamer():
+    # Created lazily so the worker thread is started in the serving process,
+    # not in a parent that forks workers afterwards
+    global _streamer
+    if _streamer is None:
+        with _streamer_lock:
+            if _streamer is None:
+                model = VLMManagedModel()
+                model.init_model()
+                _streamer = ThreadedStreamer(model.predict,
+                                             batch_size=VLM_BATCH_SIZE,
+                                             max_latency=VLM_BATCH_MAX_LATENCY)
+                logger.info(f"VLM streamer started (batch_size={VLM_BATCH_SIZE}, max_latency={VLM_BATCH_MAX_LATENCY}s)")
+    return _streamer
+
+def generate_batched(**request):
+    """Queue a single generate request to be batched with concurrent ones and wait for its result"""
+    # Future.result() without a timeout: predict() would give up after 20s,
+    # which is shorter than a typical generation
+    result = get_vlm_streamer().submit([request]).result()[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
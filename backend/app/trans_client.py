@@ -1,11 +1,10 @@
-import os
-import sys
 import logging
 from typing import Optional, Dict, Any
-from threading import Lock
+from threading import Lock, Thread
+from huggingface_hub import snapshot_download
 
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from trans_service import WhisperTranscriptionService
+from trans_service import WhisperTranscriptionService, DEFAULT_MODEL_NAME
+from utils.streaming import iterate_in_thread
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +34,23 @@ class TranscriptionClient:
                 logger.error(f"Error loading transcription model: {e}")
                 return False
     
+    def ensure_loaded(self):
+        """Load the model on first use; cheap once loaded"""
+        if self.is_model_loaded:
+            return True
+        return self.load_model()
+    
+    def start_prefetch(self):
+        """Download model weights in the background so the first load doesn't wait on the hub"""
+        Thread(target=self._download_weights, daemon=True).start()
+    
+    def _download_weights(self):
+        try:
+            snapshot_download(DEFAULT_MODEL_NAME, allow_patterns=["*.json", "*.txt", "*.safetensors"])
+            logger.info(f"Transcription model weights available: {DEFAULT_MODEL_NAME}")
+        except Exception as e:
+            logger.warning(f"Failed to prefetch transcription model weights: {e}")
+    
     def unload_model(self):
         with self.lock:
             if self.trans_service:
@@ -84,13 +100,16 @@ class TranscriptionClient:
             raise
     
     def process_audio_file(self,
-                          input_file_path: str,
-                          output_dir: str,
+                          input_file_path: str = None,
+                          output_dir: str = None,
                           return_timestamps: bool = False,
                           batch_size: int = 8,
-                          keep_mp3: bool = True):
+                          keep_mp3: bool = True,
+                          input_stream=None,
+                          input_format: str = None,
+                          input_name: str = None):
         """
-        Complete workflow: convert audio file to MP3 and transcribe
+        Complete workflow: transcribe an audio file (or stream) and optionally keep an MP3 copy
         
         Args:
             input_file_path: Path to input audio file
@@ -98,6 +117,9 @@ class TranscriptionClient:
             return_timestamps: Whether to return timestamp information
             batch_size: Batch size for processing
             keep_mp3: Whether to keep the converted MP3 file
+            input_stream: File-like object to read the audio from instead of input_file_path
+            input_format: Container format of the input
+            input_name: Original file name, used to name the MP3
         
         Returns:
             Dictionary containing transcription results and MP3 path
@@ -112,7 +134,10 @@ class TranscriptionClient:
                     output_dir=output_dir,
                     return_timestamps=return_timestamps,
                     batch_size=batch_size,
-                    keep_mp3=keep_mp3
+                    keep_mp3=keep_mp3,
+                    input_stream=input_stream,
+                    input_format=input_format,
+                    input_name=input_name
                 )
                 return result
                 
@@ -120,6 +145,29 @@ class TranscriptionClient:
             logger.error(f"Error processing audio file: {e}")
             raise
     
+    def process_audio_file_stream(self,
+                                 input_file_path: str,
+                                 output_dir: str,
+                                 return_timestamps: bool = False,
+                                 batch_size: int = 8,
+                                 keep_mp3: bool = True):
+        """
+        Transcribe an audio file window by window, yielding each window's result as it is ready
+        (see WhisperTranscriptionService.process_audio_file_stream). Transcription runs on a worker
+        thread under self.lock, via iterate_in_thread; closing the iterator stops at the next window.
+        """
+        if not self.is_model_loaded or not self.trans_service:
+            raise RuntimeError("Transcription model not loaded")
+        
+        kwargs = dict(
+            input_file_path=input_file_path,
+            output_dir=output_dir,
+            return_timestamps=return_timestamps,
+            batch_size=batch_size,
+            keep_mp3=keep_mp3
+        )
+        return iterate_in_thread(self.lock, lambda: self.trans_service.process_audio_file_stream(**kwargs))
+    
     def convert_audio_to_mp3(self, input_file_path: str, output_dir: str):
         if not self.trans_service:
             temp_service = WhisperTranscriptionService()
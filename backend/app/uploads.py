@@ -0,0 +1,163 @@
+import os
+import uuid
+import shutil
+import hashlib
+import logging
+import tempfile
+from flask import Request, current_app
+
+logger = logging.getLogger(__name__)
+
+# Read/write size for every upload copy (werkzeug's FileStorage.save uses 16KB);
+# large enough that per-chunk overhead is negligible for multi-GB media
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+_O_TMPFILE = getattr(os, 'O_TMPFILE', None)
+# Cleared after the first failed link, for filesystems that create O_TMPFILE files but cannot link them
+_use_tmpfile = _O_TMPFILE is not None
+
+def create_upload_file(directory):
+    """
+    Open a new, unnamed file in directory for an upload being written. With O_TMPFILE (Linux)
+    it has no directory entry until publish_upload_file links it in, so a crash or a failed
+    upload leaves nothing behind; elsewhere a '.part' file from mkstemp is used.
+    Returns (file, tmp_path), tmp_path being None for an O_TMPFILE file.
+    """
+    if _use_tmpfile:
+        try:
+            fd = os.open(directory, _O_TMPFILE | os.O_RDWR, 0o600)
+            return os.fdopen(fd, 'w+b'), None
+        except OSError:
+            # Filesystem without O_TMPFILE support
+            pass
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    return os.fdopen(fd, 'w+b'), tmp_path
+
+def _link_fd(fd, path):
+    """
+    linkat(AT_SYMLINK_FOLLOW) an open file to path. A plain link() of /proc/self/fd/N links the
+    magic symlink itself and fails with EXDEV. /proc/self/fd is opened per call, since a descriptor
+    opened before a fork would keep pointing at the parent's descriptors
+    """
+    proc_fd = os.open('/proc/self/fd', os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.link(str(fd), path, src_dir_fd=proc_fd, follow_symlinks=True)
+    finally:
+        os.close(proc_fd)
+
+def _link_tmpfile(file, final_path):
+    global _use_tmpfile
+    try:
+        _link_fd(file.fileno(), final_path)
+        return
+    except FileExistsError:
+        tmp_path = f'{final_path}.{uuid.uuid4().hex}.part'
+        _link_fd(file.fileno(), tmp_path)
+        os.replace(tmp_path, final_path)
+        return
+    except OSError as e:
+        logger.warning(f"Cannot link O_TMPFILE uploads ({e}), using named temporary files")
+        _use_tmpfile = False
+    
+    # Fall back to copying this one into a named temporary file
+    dst, tmp_path = create_upload_file(os.path.dirname(final_path))
+    try:
+        file.seek(0)
+        shutil.copyfileobj(file, dst, COPY_BUFFER_SIZE)
+        publish_upload_file(dst, tmp_path, final_path)
+    except BaseException:
+        discard_upload_file(dst, tmp_path)
+        raise
+
+def publish_upload_file(file, tmp_path, final_path):
+    """Atomically make a file from create_upload_file visible at final_path (replacing it), then close it"""
+    file.flush()
+    if tmp_path is None:
+        _link_tmpfile(file, final_path)
+    else:
+        os.replace(tmp_path, final_path)
+    file.close()
+
+def discard_upload_file(file, tmp_path):
+    file.close()
+    if tmp_path is not None:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class SpooledUpload:
+    """
+    Destination for one multipart file part: written straight into the upload folder
+    (and hashed) while the form is parsed, so saving it later is a link/rename, not a copy.
+    """
+
+    def __init__(self, directory):
+        self._file, self._tmp_path = create_upload_file(directory)
+        self._sha256 = hashlib.sha256()
+        self.claimed = False
+
+    @property
+    def path(self):
+        """A path other processes (e.g. ffmpeg) can open the spooled bytes by, while the request lasts"""
+        if self._tmp_path is not None:
+            return self._tmp_path
+        return f'/proc/{os.getpid()}/fd/{self._file.fileno()}'
+
+    def write(self, data):
+        self._sha256.update(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+    def claim(self, final_path):
+        """Move the spooled file to final_path; it is no longer removed when the request ends"""
+        publish_upload_file(self._file, self._tmp_path, final_path)
+        self.claimed = True
+
+    def discard(self):
+        if not self.claimed:
+            self.claimed = True
+            discard_upload_file(self._file, self._tmp_path)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class UploadRequest(Request):
+    """Request whose multipart file parts are spooled into UPLOAD_FOLDER instead of memory/tmp"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        upload = SpooledUpload(current_app.config['UPLOAD_FOLDER'])
+        self.__dict__.setdefault('_spooled_uploads', []).append(upload)
+        return upload
+
+    def close(self):
+        super().close()
+        # Parts the handler did not keep (rejected types, errors) are deleted with the request
+        for upload in self.__dict__.get('_spooled_uploads', ()):
+            upload.discard()
+
+
+def save_file(file, filepath):
+    """
+    Save an uploaded FileStorage to filepath, renaming it into place when it was spooled to disk.
+    Returns the file's sha256 hex digest, computed while the bytes were written.
+    """
+    if isinstance(file.stream, SpooledUpload):
+        file.stream.claim(filepath)
+        return file.stream.hexdigest()
+    
+    sha256 = hashlib.sha256()
+    dst, tmp_path = create_upload_file(os.path.dirname(filepath))
+    try:
+        for chunk in iter(lambda: file.stream.read(COPY_BUFFER_SIZE), b''):
+            sha256.update(chunk)
+            dst.write(chunk)
+        publish_upload_file(dst, tmp_path, filepath)
+    except BaseException:
+        discard_upload_file(dst, tmp_path)
+        raise
+    return sha256.hexdigest()
@@ -1,22 +1,21 @@
-import os
-import sys
 import logging
+import importlib
 from typing import Optional, List, Dict, Any, Iterator
 from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-# Import all available services
-from services.qwen2_5_7b_service import Qwen2_5_7BService
-from services.wiswheat_gwen_service import WisWheat_GwenService
-from services.wiswheat_llava_next_mistral_7b_service import WisWheat_LLavaNext_Mistral_7BService
+from utils.model_cache import preload_processor
+from utils.streaming import iterate_in_thread_batches
 logger = logging.getLogger(__name__)
 
-# Available models configuration
+# Available models configuration. Service modules (torch, transformers) are imported only when
+# one of their models is used; see get_service_class
 AVAILABLE_MODELS = {
     "qwen2.5-7b": {
         "display_name": "Qwen 2.5 VL 7B",
         "description": "",
-        "service_class": Qwen2_5_7BService,
+        "service_module": "services.qwen2_5_7b_service",
+        "service_class_name": "Qwen2_5_7BService",
         "supports_images": True,
         "supports_video": False,
         "memory_requirements": "~14GB VRAM"
@@ -24,7 +23,8 @@ AVAILABLE_MODELS = {
     "wiswheat-gwen-7b": {
         "display_name": "WisWheat Gwen 7B",
         "description": "",
-        "service_class": WisWheat_GwenService,
+        "service_module": "services.wiswheat_gwen_service",
+        "service_class_name": "WisWheat_GwenService",
         "service_kwargs": {"model_size": "7b"},
         "supports_images": True,
         "supports_video": False,
@@ -33,7 +33,8 @@ AVAILABLE_MODELS = {
     "wiswheat-gwen-3b": {
         "display_name": "WisWheat Gwen 3B",
         "description": "",
-        "service_class": WisWheat_GwenService,
+        "service_module": "services.wiswheat_gwen_service",
+        "service_class_name": "WisWheat_GwenService",
         "service_kwargs": {"model_size": "3b"},
         "supports_images": True,
         "supports_video": False,
@@ -42,13 +43,34 @@ AVAILABLE_MODELS = {
     "wiswheat-llava-next-mistral-7b": {
         "display_name": "WisWheat LLavaNext Mistral 7B",
         "description": "",
-        "service_class": WisWheat_LLavaNext_Mistral_7BService,
+        "service_module": "services.wiswheat_llava_next_mistral_7b_service",
+        "service_class_name": "WisWheat_LLavaNext_Mistral_7BService",
         "supports_images": True,
         "supports_video": False,
         "memory_requirements": "~14GB VRAM"
     }
 }
 
+# Inference for generate_response/generate_batch runs on this one thread, so the model (and its
+# CUDA context and thread-local state) is only ever driven from a single thread; callers wait on
+# the future. self.lock still guards against load/unload and streaming
+_vlm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='vlm')
+
+# Public description of each model, as returned by get_available_models; built once since
+# AVAILABLE_MODELS does not change. Shared by every caller, so it must not be modified
+_MODELS_INFO = {
+    model_id: {
+        key: config[key]
+        for key in ("display_name", "description", "supports_images", "supports_video", "memory_requirements")
+    }
+    for model_id, config in AVAILABLE_MODELS.items()
+}
+
+def get_service_class(model_config):
+    """Import a model's service module on first use and return its service class"""
+    module = importlib.import_module(model_config["service_module"])
+    return getattr(module, model_config["service_class_name"])
+
 class VLMClient:
     
     def __init__(self):
@@ -58,17 +80,8 @@ class VLMClient:
         self.lock = Lock()
         
     def get_available_models(self) -> Dict[str, Any]:
-        """Get list of available models with their info"""
-        models_info = {}
-        for model_id, config in AVAILABLE_MODELS.items():
-            models_info[model_id] = {
-                "display_name": config["display_name"],
-                "description": config["description"],
-                "supports_images": config["supports_images"],
-                "supports_video": config["supports_video"],
-                "memory_requirements": config["memory_requirements"]
-            }
-        return models_info
+        """Get list of available models with their info (shared, do not modify)"""
+        return _MODELS_INFO
         
     def load_model(self, model_id: str = None) -> bool:
         """Load a specific model. Can only load one model per session."""
@@ -89,7 +102,7 @@ class VLMClient:
             try:
                 logger.info(f"Loading model: {model_id}")
                 model_config = AVAILABLE_MODELS[model_id]
-                service_class = model_config["service_class"]
+                service_class = get_service_class(model_config)
                 
                 # Get service kwargs if provided
                 service_kwargs = model_config.get("service_kwargs", {})
@@ -110,6 +123,20 @@ class VLMClient:
                 self.vlm_service = None
                 return False
     
+    def preload_processors(self, model_ids: List[str]):
+        """Load the processors (not the weights) of the given models ahead of time"""
+        for model_id in model_ids:
+            if model_id not in AVAILABLE_MODELS:
+                logger.warning(f"Cannot preload processor for unknown model ID: {model_id}")
+                continue
+            model_config = AVAILABLE_MODELS[model_id]
+            try:
+                # The service itself is not built here: its __init__ initialises CUDA, which a forked worker can't inherit
+                service_class = get_service_class(model_config)
+                preload_processor(*service_class.processor_factory(**model_config.get("service_kwargs", {})))
+            except Exception as e:
+                logger.warning(f"Failed to preload processor for {model_id}: {e}")
+    
     def unload_model(self):
         """Unload the current model"""
         with self.lock:
@@ -151,33 +178,101 @@ class VLMClient:
             raise RuntimeError("No model loaded. Please load a model first.")
         
         try:
-            with self.lock:
-                # Note: Not all services support conversation_history in non-streaming mode
-                # Only pass it if the service method supports it
-                try:
-                    response = self.vlm_service.generate_response(
-                        text_input=text_input,
-                        image_paths=image_paths,
-                        conversation_history=conversation_history,
-                        max_new_tokens=max_new_tokens,
-                        temperature=temperature,
-                        upload_folder=upload_folder
-                    )
-                except TypeError:
-                    # Fallback for services that don't support conversation_history in non-streaming
-                    response = self.vlm_service.generate_response(
-                        text_input=text_input,
-                        image_paths=image_paths,
-                        max_new_tokens=max_new_tokens,
-                        temperature=temperature,
-                        upload_folder=upload_folder
-                    )
-                return response
-                
+            return _vlm_executor.submit(
+                self._generate_locked,
+                text_input=text_input,
+                image_paths=image_paths,
+                conversation_history=conversation_history,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                upload_folder=upload_folder
+            ).result()
+
         except Exception as e:
             logger.error(f"Error generating response: {e}")
             raise
-    
+
+    def _generate_locked(self, **kwargs):
+        with self.lock:
+            return self._generate_single(**kwargs)
+
+    def _generate_single(self,
+                         text_input,
+                         image_paths,
+                         conversation_history=None,
+                         max_new_tokens = 512,
+                         temperature = 0.7,
+                         upload_folder = None):
+        # Note: Not all services support conversation_history in non-streaming mode
+        # Only pass it if the service method supports it
+        try:
+            return self.vlm_service.generate_response(
+                text_input=text_input,
+                image_paths=image_paths,
+                conversation_history=conversation_history,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                upload_folder=upload_folder
+            )
+        except TypeError:
+            # Fallback for services that don't support conversation_history in non-streaming
+            return self.vlm_service.generate_response(
+                text_input=text_input,
+                image_paths=image_paths,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                upload_folder=upload_folder
+            )
+
+    def generate_batch(self, requests: List[Dict[str, Any]]) -> List[Any]:
+        """
+        Generate responses for a batch of requests (generate_response kwargs dicts).
+        Requests sharing max_new_tokens/temperature go through the service's
+        generate_batch in one forward pass when the service provides it.
+
+        Returns:
+            One entry per request: the response text, or the exception raised for it
+        """
+        if not self.is_model_loaded or not self.vlm_service:
+            error = RuntimeError("No model loaded. Please load a model first.")
+            return [error] * len(requests)
+
+        return _vlm_executor.submit(self._generate_batch, requests).result()
+
+    def _generate_batch(self, requests):
+        # Sampling parameters are shared by a generate() call, so group on them
+        groups = {}
+        for index, request in enumerate(requests):
+            key = (request.get('max_new_tokens', 512), request.get('temperature', 0.7))
+            groups.setdefault(key, []).append(index)
+
+        results = [None] * len(requests)
+        with self.lock:
+            for indices in groups.values():
+                batch = [requests[i] for i in indices]
+                outputs = None
+
+                if len(batch) > 1 and hasattr(self.vlm_service, 'generate_batch'):
+                    try:
+                        outputs = self.vlm_service.generate_batch(batch)
+                        logger.info(f"Generated batch of {len(batch)} responses")
+                    except Exception as e:
+                        logger.warning(f"Batched generation failed, retrying one by one: {e}")
+
+                if outputs is None:
+                    outputs = []
+                    for request in batch:
+                        try:
+                            outputs.append(self._generate_single(**request))
+                        except Exception as e:
+                            logger.error(f"Error generating response: {e}")
+                            outputs.append(e)
+
+                for index, output in zip(indices, outputs):
+                    results[index] = output
+
+        return results
+
     def generate_response_stream(self, 
                                text_input,
                                image_paths,
@@ -185,25 +280,34 @@ class VLMClient:
                                max_new_tokens = 512,
                                temperature = 0.7,
                                upload_folder = None) -> Iterator[str]:
+        for batch in self.generate_response_stream_batches(
+            max_batch=1,
+            max_delay=0,
+            text_input=text_input,
+            image_paths=image_paths,
+            conversation_history=conversation_history,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            upload_folder=upload_folder
+        ):
+            yield from batch
+
+    def generate_response_stream_batches(self, max_batch=8, max_delay=0.03, **kwargs) -> Iterator[List[str]]:
+        """
+        Stream a response (generate_response_stream kwargs) in lists of up to max_batch tokens,
+        each waiting at most max_delay seconds for more tokens. The model runs on _vlm_executor under
+        self.lock (see iterate_in_thread_batches); closing the iterator stops generation at the next token.
+        """
         if not self.is_model_loaded or not self.vlm_service:
             raise RuntimeError("No model loaded. Please load a model first.")
         
-        try:
-            with self.lock:
-                for token in self.vlm_service.generate_response_stream(
-                    text_input=text_input,
-                    image_paths=image_paths,
-                    conversation_history=conversation_history,
-                    max_new_tokens=max_new_tokens,
-                    temperature=temperature,
-                    upload_folder=upload_folder
-                ):
-                    yield token
-                
-        except Exception as e:
-            logger.error(f"Error generating streaming response: {e}")
-            raise
-
+        return iterate_in_thread_batches(
+            self.lock,
+            lambda: self.vlm_service.generate_response_stream(**kwargs),
+            submit=_vlm_executor.submit,
+            max_batch=max_batch,
+            max_delay=max_delay
+        )
 
 _vlm_client = None
 
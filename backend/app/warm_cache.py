@@ -0,0 +1,33 @@
+"""
+Pre-build the processor cache used at model load time.
+Run at image build time (python -m app.warm_cache) so the first start skips the hub lookups.
+"""
+import sys
+import logging
+from app.http import configure_hub_http
+from app.vlm_client import AVAILABLE_MODELS, get_service_class
+from utils.model_cache import save_processor, MODEL_META_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+def warm_cache(model_ids=None) -> bool:
+    ok = True
+    for model_id in model_ids or AVAILABLE_MODELS:
+        model_config = AVAILABLE_MODELS[model_id]
+        try:
+            service_class = get_service_class(model_config)
+            model_name, factory = service_class.processor_factory(**model_config.get("service_kwargs", {}))
+            if not save_processor(model_name, factory()):
+                ok = False
+                continue
+            logger.info(f"Cached processor for {model_id} ({model_name})")
+        except Exception as e:
+            logger.error(f"Failed to cache processor for {model_id}: {e}")
+            ok = False
+    return ok
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    configure_hub_http()
+    logger.info(f"Warming processor cache in {MODEL_META_CACHE_DIR}")
+    sys.exit(0 if warm_cache(sys.argv[1:]) else 1)
@@ -0,0 +1,8 @@
+import os
+from a2wsgi import WSGIMiddleware
+from app import create_app
+
+# ASGI entrypoint: uvicorn asgi:application --workers 1
+# The Flask app runs on a thread pool behind the event loop, so slow generate and
+# transcription requests each hold a pool thread while the loop keeps accepting connections
+application = WSGIMiddleware(create_app(), workers=int(os.environ.get('ASGI_THREADS', 64)))
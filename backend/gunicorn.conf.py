@@ -0,0 +1,17 @@
+import os
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', 5000)}"
+
+# One worker owns the GPU; concurrent requests are served by its threads,
+# which share the loaded models (VLMClient/TranscriptionClient lock around inference)
+workers = 1
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 64))
+
+# Import the app once in the master so workers share its memory copy-on-write.
+# Set PRELOAD_PROCESSORS=<model ids> to load tokenizers/processors there as well;
+# model weights are loaded from safetensors, which are mmapped rather than copied
+preload_app = True
+
+# Generation and transcription requests can take minutes
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 600))
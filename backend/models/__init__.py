@@ -1,3 +1,94 @@
+import os
+import hashlib
+import logging
+import sqlite3
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateTable, CreateIndex
 
-db = SQLAlchemy()
+logger = logging.getLogger(__name__)
+
+# Loaded rows stay usable after commit (e.g. history passed to a streaming generator)
+# instead of being re-fetched one by one on first attribute access
+db = SQLAlchemy(session_options={'expire_on_commit': False})
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers proceed while a write is in progress; NORMAL sync is safe with WAL
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        # SQLite ignores foreign keys (and so ON DELETE CASCADE) unless enabled per connection
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+# Columns added to tables after they were first created, which create_all does not add to an
+# existing database: (table, column, column DDL, SQL that backfills it)
+_ADDED_COLUMNS = [
+    ('chat_sessions', 'message_count', 'INTEGER NOT NULL DEFAULT 0',
+     'UPDATE chat_sessions SET message_count = '
+     '(SELECT COUNT(*) FROM chat_messages WHERE chat_messages.session_id = chat_sessions.id)'),
+]
+
+def _add_missing_columns():
+    with db.engine.begin() as connection:
+        inspector = inspect(connection)
+        for table, column, ddl, backfill in _ADDED_COLUMNS:
+            if column in {c['name'] for c in inspector.get_columns(table)}:
+                continue
+            connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+            connection.execute(text(backfill))
+            logger.info(f"Added column {table}.{column}")
+
+# Indexes since removed from the models, dropped from existing databases
+_DROPPED_INDEXES = ['idx_message_type', 'idx_message_session_id']
+
+def _sync_indexes():
+    """create_all skips tables that already exist, so create their new indexes and drop removed ones"""
+    with db.engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in db.metadata.sorted_tables:
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(connection)
+                    logger.info(f"Created index {index.name}")
+        for name in _DROPPED_INDEXES:
+            connection.execute(text(f'DROP INDEX IF EXISTS {name}'))
+
+def _schema_hash() -> str:
+    dialect = sqlite.dialect()
+    ddl = []
+    for table in db.metadata.sorted_tables:
+        ddl.append(str(CreateTable(table).compile(dialect=dialect)))
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            ddl.append(str(CreateIndex(index).compile(dialect=dialect)))
+    return hashlib.sha1('\n'.join(ddl).encode('utf-8')).hexdigest()
+
+def ensure_schema():
+    """Run create_all only when the models changed since the last start (tracked in <database>.schema_hash)"""
+    # Flask-SQLAlchemy resolves relative SQLite paths against the instance folder
+    db_path = db.engine.url.database
+    hash_path = db_path + '.schema_hash'
+    schema_hash = _schema_hash()
+    if os.path.exists(db_path):
+        try:
+            with open(hash_path) as f:
+                if f.read().strip() == schema_hash:
+                    logger.info("Database schema unchanged, skipping create_all")
+                    return
+        except FileNotFoundError:
+            pass
+    
+    db.create_all()
+    _add_missing_columns()
+    _sync_indexes()
+    try:
+        with open(hash_path, 'w') as f:
+            f.write(schema_hash)
+    except OSError as e:
+        logger.warning(f"Failed to write schema hash: {e}")
+    logger.info("Database tables created/verified")
@@ -1,8 +1,14 @@
 import datetime
 import uuid
-import hashlib
+from collections import Counter, namedtuple
+import xxhash
+from sqlalchemy import event, exists, literal, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from . import db
 
+# Columns of a message as returned in conversation history
+HistoryMessage = namedtuple('HistoryMessage', ('id', 'message_type', 'content', 'images', 'created_at'))
+
 class ChatSession(db.Model):
     __tablename__ = 'chat_sessions'
     
@@ -21,22 +27,32 @@ class ChatSession(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
     # Updated at timestamp (updates when new messages are added)
     updated_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    # Number of messages, kept up to date by the ChatMessage insert/delete events below
+    message_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     
-    # Relationship to messages
-    messages = db.relationship('ChatMessage', backref='session', cascade='all, delete-orphan', lazy=True)
+    # Relationship to messages, in conversation order. Loaded only on access: session lists read
+    # message_count instead, and get_session reads plain rows via ChatMessage.dicts_for_session
+    # ORM deletes leave the messages to the foreign key's ON DELETE CASCADE (passive_deletes)
+    messages = db.relationship('ChatMessage', back_populates='session', cascade='all, delete-orphan', lazy='select',
+                               order_by='ChatMessage.created_at', passive_deletes=True)
     
     def to_dict(self):
-        created_iso = self.created_at.isoformat(timespec='seconds') + 'Z' if self.created_at else None
-        updated_iso = self.updated_at.isoformat(timespec='seconds') + 'Z' if self.updated_at else None
+        # Datetimes are left for the JSON provider to format
         return {
             'id': self.id,
             'name': self.name,
             'model_id': self.model_id,
-            'created_at': created_iso,
-            'updated_at': updated_iso,
-            'message_count': len(self.messages) if self.messages else 0
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+            'message_count': self.message_count or 0
         }
     
+    @staticmethod
+    def delete_with_messages(session_id):
+        """Delete a session and its messages with one DELETE statement each. Does not commit."""
+        db.session.execute(ChatMessage.__table__.delete().where(ChatMessage.__table__.c.session_id == session_id))
+        db.session.execute(ChatSession.__table__.delete().where(ChatSession.__table__.c.id == session_id))
+    
     def __repr__(self):
         return f'<ChatSession {self.id} {self.name} {self.model_id}>'
 
@@ -44,9 +60,9 @@ class ChatMessage(db.Model):
     __tablename__ = 'chat_messages'
     
     __table_args__ = (
-        db.Index('idx_message_session_id', 'session_id'),
         db.Index('idx_message_created_at', 'created_at'),
-        db.Index('idx_message_type', 'message_type'),
+        # A session's messages in order (history, get_session); also serves lookups by session_id alone
+        db.Index('idx_message_session_created', 'session_id', 'created_at'),
         # Composite index for efficient duplicate checking
         db.Index('idx_message_deduplication', 'session_id', 'message_type', 'content_hash', 'created_at'),
     )
@@ -54,12 +70,12 @@ class ChatMessage(db.Model):
     # Message unique identifier (UUIDv4)
     id = db.Column(db.String(36), primary_key=True, nullable=False, default=lambda: str(uuid.uuid4()))
     # Session ID this message belongs to
-    session_id = db.Column(db.String(36), db.ForeignKey('chat_sessions.id'), nullable=False)
+    session_id = db.Column(db.String(36), db.ForeignKey('chat_sessions.id', ondelete='CASCADE'), nullable=False)
     # Message type: 'user' or 'assistant'
     message_type = db.Column(db.String(20), nullable=False)
     # Message content
     content = db.Column(db.Text, nullable=False)
-    # Content hash for efficient duplicate detection (SHA256 of content + session_id + message_type)
+    # Content hash for efficient duplicate detection (xxh3 of session_id + message_type + content, see generate_content_hash)
     content_hash = db.Column(db.String(64), nullable=True, index=True)
     # Image paths used in this message (JSON string)
     images = db.Column(db.Text, nullable=True)  # JSON string of image paths
@@ -70,13 +86,24 @@ class ChatMessage(db.Model):
     # Created at timestamp
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
     
-    def generate_content_hash(self):
-        """Generate SHA256 hash of content + session_id + message_type for duplicate detection"""
-        content_for_hash = f"{self.session_id}:{self.message_type}:{self.content}"
-        return hashlib.sha256(content_for_hash.encode('utf-8')).hexdigest()
+    session = db.relationship('ChatSession', back_populates='messages')
+    
+    @staticmethod
+    def generate_content_hash(session_id, message_type, content):
+        """Generate xxh3 hash of content + session_id + message_type for duplicate detection (not cryptographic)"""
+        content_for_hash = f"{session_id}:{message_type}:{content}"
+        return xxhash.xxh3_64_hexdigest(content_for_hash.encode('utf-8'))
+    
+    @staticmethod
+    def batch_generate_content_hashes(items):
+        """generate_content_hash for many (session_id, message_type, content) tuples, in order (imports, backfills)"""
+        generate = ChatMessage.generate_content_hash
+        return [generate(*item) for item in items]
+    
+    # Columns to_dict() exposes (everything but content_hash)
+    _DICT_COLUMNS = ('id', 'session_id', 'message_type', 'content', 'images', 'images_used', 'user_input', 'created_at')
     
     def to_dict(self):
-        created_iso = self.created_at.isoformat(timespec='seconds') + 'Z' if self.created_at else None
         return {
             'id': self.id,
             'session_id': self.session_id,
@@ -85,12 +112,123 @@ class ChatMessage(db.Model):
             'images': self.images,
             'images_used': self.images_used,
             'user_input': self.user_input,
-            'created_at': created_iso
+            'created_at': self.created_at
         }
     
     def __repr__(self):
         return f'<ChatMessage {self.id} {self.session_id} {self.message_type}>'
     
+    @staticmethod
+    def dicts_for_session(session_id):
+        """
+        The session's messages as to_dict()-shaped dicts, in created_at order, read with a Core
+        SELECT straight into row mappings (no ORM instances), for read-only serialization
+        """
+        messages = ChatMessage.__table__
+        columns = [messages.c[name] for name in ChatMessage._DICT_COLUMNS]
+        rows = db.session.execute(
+            select(*columns).where(messages.c.session_id == session_id).order_by(messages.c.created_at)
+        ).mappings()
+        return [dict(row) for row in rows]
+    
+    @staticmethod
+    def references_image(name):
+        """Whether any stored message lists the upload name among its images (a JSON list of names)"""
+        messages = ChatMessage.__table__
+        return db.session.execute(
+            select(messages.c.id).where(messages.c.images.contains(f'"{name}"', autoescape=True)).limit(1)
+        ).first() is not None
+    
+    @staticmethod
+    def insert_assistant_message(session_id, content, content_hash, images_used=0, user_input=None,
+                                 message_id=None, dedup_seconds=30):
+        """
+        Store an assistant message with a single INSERT ... SELECT ... ON CONFLICT DO NOTHING RETURNING,
+        skipping it when message_id is already taken or the same content was stored for the session
+        within dedup_seconds. Also bumps the session's message_count and updated_at. Does not commit.
+        
+        Returns:
+            The new message's id, or None if it was a duplicate
+        """
+        messages = ChatMessage.__table__
+        row = {
+            'id': message_id or str(uuid.uuid4()),
+            'session_id': session_id,
+            'message_type': 'assistant',
+            'content': content,
+            'content_hash': content_hash,
+            'images': None,
+            'images_used': images_used,
+            'user_input': user_input,
+            'created_at': datetime.datetime.utcnow(),
+        }
+        recent_duplicate = select(messages.c.id).where(
+            messages.c.session_id == session_id,
+            messages.c.message_type == 'assistant',
+            messages.c.content_hash == content_hash,
+            # Cutoff from SQLite's own UTC clock; its text compares correctly with stored DateTimes
+            messages.c.created_at >= db.func.datetime('now', f'-{int(dedup_seconds)} seconds'),
+        )
+        values = select(*[literal(value, messages.c[name].type) for name, value in row.items()])\
+            .where(~exists(recent_duplicate))
+        stmt = sqlite_insert(messages).from_select(list(row), values)\
+            .on_conflict_do_nothing(index_elements=['id'])\
+            .returning(messages.c.id)
+        inserted_id = db.session.execute(stmt).scalar()
+        
+        # A Core insert does not fire the ORM after_insert event, so the counter is updated here
+        if inserted_id is not None:
+            sessions = ChatSession.__table__
+            db.session.execute(
+                sessions.update()
+                .where(sessions.c.id == session_id)
+                .values(message_count=sessions.c.message_count + 1, updated_at=db.func.now())
+            )
+        return inserted_id
+    
+    @staticmethod
+    def bulk_create(dicts, page_size=1000):
+        """
+        Insert many messages (e.g. a conversation import) with Core executemany INSERTs of up to
+        page_size rows, instead of one ORM flush per message. Each dict needs session_id, message_type
+        and content; id, content_hash and created_at are filled in when missing, the created_at values
+        increasing in input order so the messages keep their order. Bumps each session's
+        message_count and updated_at. Does not commit.
+        
+        Returns:
+            The inserted message ids, in input order
+        """
+        dicts = list(dicts)
+        messages = ChatMessage.__table__
+        now = datetime.datetime.utcnow()
+        hashes = ChatMessage.batch_generate_content_hashes(
+            (d['session_id'], d['message_type'], d['content']) for d in dicts)
+        rows = [{
+            'id': d.get('id') or str(uuid.uuid4()),
+            'session_id': d['session_id'],
+            'message_type': d['message_type'],
+            'content': d['content'],
+            'content_hash': d.get('content_hash') or content_hash,
+            'images': d.get('images'),
+            'images_used': d.get('images_used', 0),
+            'user_input': d.get('user_input'),
+            # One microsecond apart, so history pairing and ORDER BY created_at never see ties
+            'created_at': d.get('created_at') or now + datetime.timedelta(microseconds=i),
+        } for i, (d, content_hash) in enumerate(zip(dicts, hashes))]
+        
+        for start in range(0, len(rows), page_size):
+            db.session.execute(messages.insert(), rows[start:start + page_size])
+        
+        # Core inserts do not fire the ORM after_insert event, so the counters are updated here
+        sessions = ChatSession.__table__
+        for session_id, count in Counter(row['session_id'] for row in rows).items():
+            db.session.execute(
+                sessions.update()
+                .where(sessions.c.id == session_id)
+                .values(message_count=sessions.c.message_count + count, updated_at=db.func.now())
+            )
+        return [row['id'] for row in rows]
+    
     @staticmethod
     def get_conversation_history(session_id: str, limit_pairs: int = 5, exclude_latest_user: bool = False):
         """
@@ -103,41 +241,51 @@ class ChatMessage(db.Model):
             exclude_latest_user: Whether to exclude the most recent user message (default: False)
             
         Returns:
-            List of tuples (user_message, assistant_message) ordered from oldest to newest
+            List of tuples (user_message, assistant_message) of HistoryMessage, ordered from oldest to newest
         """
-        # Get all messages for this session, ordered by creation time (newest first)
-        query = ChatMessage.query.filter_by(session_id=session_id)\
-                                 .order_by(ChatMessage.created_at.desc())
-        
-        # If we want to exclude the latest user message (e.g., when getting context for response generation)
-        if exclude_latest_user:
-            # Get all messages and skip the first one if it's a user message
-            all_messages = query.all()
-            if all_messages and all_messages[0].message_type == 'user':
-                messages = all_messages[1:]  # Skip the latest user message
-            else:
-                messages = all_messages
-        else:
-            # Limit to avoid getting too many messages
-            messages = query.limit(limit_pairs * 2 + 2).all()  # +2 for safety buffer
+        # Each user message is paired with the message right after it when that is an assistant reply,
+        # using LEAD() over the session's messages; only the newest limit_pairs pairs are fetched.
+        # A trailing user message has no reply, so exclude_latest_user needs no extra handling
+        messages = ChatMessage.__table__
+        created_at = messages.c.created_at
+        paired = select(
+            messages.c.id,
+            messages.c.message_type,
+            created_at,
+            db.func.lead(messages.c.id).over(order_by=created_at).label('next_id'),
+            db.func.lead(messages.c.message_type).over(order_by=created_at).label('next_type'),
+        ).where(messages.c.session_id == session_id).subquery()
         
-        # Reverse to get chronological order (oldest first)
-        messages.reverse()
+        # Plain column rows, not ORM instances: history is only read (content, images), never modified
+        user_message, assistant_message = messages.alias('user_message'), messages.alias('assistant_message')
+        rows = db.session.execute(
+            select(*[user_message.c[name] for name in HistoryMessage._fields],
+                   *[assistant_message.c[name] for name in HistoryMessage._fields])
+            .select_from(paired)
+            .join(user_message, user_message.c.id == paired.c.id)
+            .join(assistant_message, assistant_message.c.id == paired.c.next_id)
+            .where(paired.c.message_type == 'user', paired.c.next_type == 'assistant')
+            .order_by(paired.c.created_at.desc())
+            .limit(limit_pairs)
+        ).all()
         
-        # Group messages into conversation pairs
-        conversation_pairs = []
-        i = 0
-        while i < len(messages) - 1:  # -1 because we need pairs
-            current_msg = messages[i]
-            next_msg = messages[i + 1] if i + 1 < len(messages) else None
-            
-            # Look for user-assistant pairs
-            if (current_msg.message_type == 'user' and 
-                next_msg and next_msg.message_type == 'assistant'):
-                conversation_pairs.append((current_msg, next_msg))
-                i += 2  # Skip both messages since we paired them
-            else:
-                i += 1  # Skip this message and try the next one
-        
-        # Return the most recent pairs up to the limit, but maintain chronological order
-        return conversation_pairs[-limit_pairs:] if len(conversation_pairs) > limit_pairs else conversation_pairs
\ No newline at end of file
+        # Newest first from the query; callers expect chronological order
+        width = len(HistoryMessage._fields)
+        return [(HistoryMessage._make(row[:width]), HistoryMessage._make(row[width:])) for row in reversed(rows)]
+
+
+def _adjust_message_count(connection, session_id, delta):
+    sessions = ChatSession.__table__
+    connection.execute(
+        sessions.update()
+        .where(sessions.c.id == session_id)
+        .values(message_count=sessions.c.message_count + delta)
+    )
+
+@event.listens_for(ChatMessage, 'after_insert')
+def _message_inserted(mapper, connection, target):
+    _adjust_message_count(connection, target.session_id, 1)
+
+@event.listens_for(ChatMessage, 'after_delete')
+def _message_deleted(mapper, connection, target):
+    _adjust_message_count(connection, target.session_id, -1)
@@ -5,6 +5,7 @@ import torch
 import gc
 import json
 import logging
+from functools import partial
 from typing import List, Optional, Dict, Any, Iterator
 from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, TextIteratorStreamer
 
@@ -23,15 +24,23 @@ import time
 from threading import Thread
 from flask import current_app
 from utils.common import preprocess_image_in_memory
+from utils.model_cache import load_cached_processor
+from utils.vision_cache import VisionEmbeddingCache
 
 logger = logging.getLogger(__name__)
 
 class Qwen2_5_7BService:
+    MODEL_NAME = "Qwen/Qwen2.5-VL-7B-Instruct"
+    # Reduced pixel limits for memory efficiency
+    MIN_PIXELS = 256 * 28 * 28
+    MAX_PIXELS = 1280 * 28 * 28
+    
     def __init__(self, device_map: str = "cuda"):
-        self.model_name = "Qwen/Qwen2.5-VL-7B-Instruct"
+        self.model_name = self.MODEL_NAME
         self.device_map = device_map
         self.model = None
         self.processor = None
+        self.vision_cache = None
         self.is_loaded = False
         
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -41,10 +50,27 @@ class Qwen2_5_7BService:
         
         # Memory optimization settings
         self.max_image_size = (1024, 1024)  # Limit image size to reduce memory usage
-        self.min_pixels = 256 * 28 * 28     # Reduce minimum pixels for memory efficiency
-        self.max_pixels = 1280 * 28 * 28    # Reduce maximum pixels for memory efficiency
+        self.min_pixels = self.MIN_PIXELS
+        self.max_pixels = self.MAX_PIXELS
         self.max_images_per_request = 10    # Maximum number of images per request
         
+    @staticmethod
+    def create_processor(model_name, min_pixels, max_pixels):
+        """Build the processor (tokenizer + image processor) with reduced pixel limits"""
+        return AutoProcessor.from_pretrained(
+            model_name,
+            min_pixels=min_pixels,
+            max_pixels=max_pixels
+        )
+    
+    @classmethod
+    def processor_factory(cls, **service_kwargs):
+        """
+        (model name, no-argument processor factory) for a service built with service_kwargs, without
+        building it: __init__ calls torch.cuda.is_available(), which must not run in the gunicorn master
+        """
+        return cls.MODEL_NAME, partial(cls.create_processor, cls.MODEL_NAME, cls.MIN_PIXELS, cls.MAX_PIXELS)
+
     def load_model(self) -> bool:
         if self.is_loaded:
             logger.info("Qwen2.5-7B model already loaded")
@@ -66,11 +92,12 @@ class Qwen2_5_7BService:
             ).eval()
             
             # Load processor with reduced pixel limits
-            self.processor = AutoProcessor.from_pretrained(
-                self.model_name,
-                min_pixels=self.min_pixels,
-                max_pixels=self.max_pixels
-            )
+            self.processor = load_cached_processor(
+                self.model_name, partial(self.create_processor, self.model_name, self.min_pixels, self.max_pixels))
+            # Left padding keeps every prompt of a batch ending at the generation position
+            self.processor.tokenizer.padding_side = "left"
+            # Reuse vision tower outputs for images sent again (e.g. follow-up questions)
+            self.vision_cache = VisionEmbeddingCache.attach(self.model)
             
             self.is_loaded = True
             logger.info(f"Qwen2.5-7B model loaded successfully with memory optimizations.")
@@ -90,6 +117,8 @@ class Qwen2_5_7BService:
             del self.processor
             self.processor = None
         
+        self.vision_cache = None
+        
         self.is_loaded = False
         
         logger.info("Qwen2.5-7B model cleanup completed")
@@ -189,6 +218,70 @@ class Qwen2_5_7BService:
         
         return messages, processed_images_for_cleanup
     
+    def _build_inputs(self, requests: List[Dict[str, Any]]):
+        """Tokenize a batch of requests into one left-padded input batch on the model device."""
+        conversations = [
+            self._create_messages(request["text_input"], request.get("image_paths"), request.get("conversation_history"),
+                                  include_system_prompt=True, upload_folder=request.get("upload_folder"))[0]
+            for request in requests
+        ]
+        
+        texts = [
+            self.processor.apply_chat_template(
+                messages, 
+                tokenize=False, 
+                add_generation_prompt=True,
+                add_vision_id=True  # Add vision IDs like "Picture 1:", "Picture 2:", etc.
+            )
+            for messages in conversations
+        ]
+        
+        # Vision inputs of all conversations, in batch order
+        image_inputs, video_inputs = process_vision_info(conversations)
+        
+        inputs = self.processor(
+            text=texts,
+            images=image_inputs,
+            videos=video_inputs,
+            padding=True,
+            return_tensors="pt",
+        )
+        if self.vision_cache is not None:
+            self.vision_cache.set_inputs(inputs)
+        # Move inputs to device with correct dtype
+        return inputs.to(self.model.device, dtype=torch.float16)
+    
+    def _generate(self, inputs, max_new_tokens: int, temperature: float) -> List[str]:
+        """Run model.generate on a prepared batch and decode only the new tokens."""
+        with torch.inference_mode():
+            if temperature > 0:
+                generated_ids = self.model.generate(
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=True,
+                    temperature=temperature,
+                    use_cache=True,
+                    pad_token_id=self.processor.tokenizer.eos_token_id,
+                )
+            else:
+                generated_ids = self.model.generate(
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=False,
+                    use_cache=True,
+                    pad_token_id=self.processor.tokenizer.eos_token_id,
+                )
+            
+            # Prompts are left-padded to a common length, so new tokens start at the same offset
+            generated_ids_trimmed = generated_ids[:, inputs.input_ids.shape[1]:]
+        
+        output_texts = self.processor.batch_decode(
+            generated_ids_trimmed, 
+            skip_special_tokens=True, 
+            clean_up_tokenization_spaces=False
+        )
+        return [text.strip() for text in output_texts]
+    
     def generate_response(self, 
                          text_input: str, 
                          image_paths: Optional[List[str]] = None,
@@ -198,84 +291,39 @@ class Qwen2_5_7BService:
                          do_sample: bool = True,
                          upload_folder: Optional[str] = None) -> str:
         
+        request = {
+            "text_input": text_input,
+            "image_paths": image_paths,
+            "conversation_history": conversation_history,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature if do_sample else 0.0,
+            "upload_folder": upload_folder,
+        }
+        return self.generate_batch([request])[0]
+    
+    def generate_batch(self, requests: List[Dict[str, Any]]) -> List[str]:
+        """
+        Generate responses for several requests in a single batched forward pass.
+        Each request is a dict of generate_response keyword arguments; all of them
+        must share max_new_tokens and temperature.
+        """
         if not self.is_loaded:
             raise RuntimeError("Qwen2.5-7B model not loaded. Please call load_model() first.")
         
+        max_new_tokens = requests[0].get("max_new_tokens", 512)
+        temperature = requests[0].get("temperature", 0.7)
+        
         try:
-            
-            messages, _ = self._create_messages(text_input, image_paths, conversation_history, include_system_prompt=True, upload_folder=upload_folder)
-            
-            # Apply chat template to get text
-            text = self.processor.apply_chat_template(
-                messages, 
-                tokenize=False, 
-                add_generation_prompt=True,
-                add_vision_id=True  # Add vision IDs like "Picture 1:", "Picture 2:", etc.
-            )
-            
-            # Process vision information
-            image_inputs, video_inputs = process_vision_info(messages)
-            
-            # Prepare inputs with memory-efficient settings
-            inputs = self.processor(
-                text=[text],
-                images=image_inputs,
-                videos=video_inputs,
-                padding=True,
-                return_tensors="pt",
-            )
-            
-            # Move inputs to device with correct dtype
-            inputs = inputs.to(self.model.device, dtype=torch.float16)
-            
-            # Generate response with memory optimizations
-            with torch.inference_mode():
-                if do_sample and temperature > 0:
-                    generated_ids = self.model.generate(
-                        **inputs,
-                        max_new_tokens=max_new_tokens,
-                        do_sample=True,
-                        temperature=temperature,
-                        use_cache=True,
-                        pad_token_id=self.processor.tokenizer.eos_token_id,
-                    )
-                else:
-                    generated_ids = self.model.generate(
-                        **inputs,
-                        max_new_tokens=max_new_tokens,
-                        do_sample=False,
-                        use_cache=True,
-                        pad_token_id=self.processor.tokenizer.eos_token_id,
-                    )
-                
-                # Extract only the new tokens
-                generated_ids_trimmed = [
-                    out_ids[len(in_ids):] 
-                    for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-                ]
-            
-            # Decode the response
-            output_text = self.processor.batch_decode(
-                generated_ids_trimmed, 
-                skip_special_tokens=True, 
-                clean_up_tokenization_spaces=False
-            )
-            
-            # No cleanup needed - images processed in memory
-            
-            # Clear cache after processing
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            
-            # Return the first (and should be only) response
-            return output_text[0].strip() if output_text else ""
+            inputs = self._build_inputs(requests)
+            return self._generate(inputs, max_new_tokens, temperature)
             
         except Exception as e:
             logger.error(f"Error during Qwen2.5-7B response generation: {str(e)}")
-            # Clear cache on error
+            raise
+        finally:
+            # Clear cache after processing, and on error
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
-            raise
     
     def generate_response_stream(self, 
                                text_input: str, 
@@ -310,6 +358,8 @@ class Qwen2_5_7BService:
                 padding=True,
                 return_tensors="pt",
             )
+            if self.vision_cache is not None:
+                self.vision_cache.set_inputs(inputs)
             # Fix data type mismatch - use correct dtype when moving to device
             inputs = inputs.to(self.device, dtype=torch.float16)
             
@@ -5,6 +5,7 @@ import torch
 import gc
 import json
 import logging
+from functools import partial
 from typing import List, Optional, Dict, Any, Iterator
 from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, TextIteratorStreamer
 
@@ -23,10 +24,18 @@ import time
 from threading import Thread
 from flask import current_app
 from utils.common import preprocess_image_in_memory
+from utils.model_cache import load_cached_processor
+from utils.vision_cache import VisionEmbeddingCache
 
 logger = logging.getLogger(__name__)
 
 class WisWheat_GwenService:
+    # Reduced pixel limits for memory efficiency
+    MIN_PIXELS = 256 * 28 * 28
+    MAX_PIXELS = 1280 * 28 * 28
+    # Generation length cap, for memory efficiency
+    MAX_NEW_TOKENS = 256
+    
     def __init__(self, model_size: str = "3b", device_map: str = None):
         """
         Initialize WisWheat Gwen service with configurable model size.
@@ -35,11 +44,8 @@ class WisWheat_GwenService:
             model_size: Either "3b" or "7b" to select the model variant
             device_map: Device mapping strategy. If None, auto-configured based on model size
         """
-        if model_size not in ["3b", "7b"]:
-            raise ValueError(f"Invalid model_size '{model_size}'. Must be '3b' or '7b'")
-        
+        self.model_name = self.model_name_for(model_size)
         self.model_size = model_size
-        self.model_name = f"WisWheat/WisWheat_Qwen-{model_size.upper()}"
         
         # Auto-configure device_map based on model size if not provided
         if device_map is None:
@@ -49,6 +55,7 @@ class WisWheat_GwenService:
             
         self.model = None
         self.processor = None
+        self.vision_cache = None
         self.is_loaded = False
                 
         # Configure device based on model size
@@ -62,11 +69,32 @@ class WisWheat_GwenService:
         self.system_prompt = "You are a helpful assistant."
         
         self.max_image_size = (1024, 1024)  
-        self.min_pixels = 256 * 28 * 28     
-        self.max_pixels = 1280 * 28 * 28
+        self.min_pixels = self.MIN_PIXELS
+        self.max_pixels = self.MAX_PIXELS
         self.max_images_per_request = 10    # Maximum number of images per request    
         
         
+    @staticmethod
+    def model_name_for(model_size: str) -> str:
+        if model_size not in ["3b", "7b"]:
+            raise ValueError(f"Invalid model_size '{model_size}'. Must be '3b' or '7b'")
+        return f"WisWheat/WisWheat_Qwen-{model_size.upper()}"
+    
+    @staticmethod
+    def create_processor(model_name, min_pixels, max_pixels):
+        """Build the processor (tokenizer + image processor) with reduced pixel limits"""
+        return AutoProcessor.from_pretrained(
+            model_name,
+            min_pixels=min_pixels,
+            max_pixels=max_pixels
+        )
+    
+    @classmethod
+    def processor_factory(cls, model_size: str = "3b", **service_kwargs):
+        """Model name and processor factory for model_size, without constructing the service (see Qwen2_5_7BService)"""
+        model_name = cls.model_name_for(model_size)
+        return model_name, partial(cls.create_processor, model_name, cls.MIN_PIXELS, cls.MAX_PIXELS)
+
     def load_model(self) -> bool:
         if self.is_loaded:
             logger.info(f"WisWheat-Gwen-{self.model_size.upper()} model already loaded")
@@ -88,11 +116,12 @@ class WisWheat_GwenService:
             ).eval()
             
             # Load processor with reduced pixel limits
-            self.processor = AutoProcessor.from_pretrained(
-                self.model_name,
-                min_pixels=self.min_pixels,
-                max_pixels=self.max_pixels,
-            )
+            self.processor = load_cached_processor(
+                self.model_name, partial(self.create_processor, self.model_name, self.min_pixels, self.max_pixels))
+            # Left padding keeps every prompt of a batch ending at the generation position
+            self.processor.tokenizer.padding_side = "left"
+            # Reuse vision tower outputs for images sent again (e.g. follow-up questions)
+            self.vision_cache = VisionEmbeddingCache.attach(self.model)
             
             self.is_loaded = True
             logger.info(f"WisWheat-Gwen-{self.model_size.upper()} model loaded successfully with memory optimizations.")
@@ -112,6 +141,8 @@ class WisWheat_GwenService:
             del self.processor
             self.processor = None
         
+        self.vision_cache = None
+        
         self.is_loaded = False
         
         # Aggressive memory cleanup
@@ -217,6 +248,69 @@ class WisWheat_GwenService:
         
         return messages, processed_images_for_cleanup
     
+    def _build_inputs(self, requests: List[Dict[str, Any]]):
+        """Same as Qwen2_5_7BService._build_inputs, without the system prompt or vision IDs."""
+        conversations = [
+            self._create_messages(request["text_input"], request.get("image_paths"), request.get("conversation_history"),
+                                  include_system_prompt=False, upload_folder=request.get("upload_folder"))[0]
+            for request in requests
+        ]
+        
+        texts = [
+            self.processor.apply_chat_template(
+                messages, 
+                tokenize=False, 
+                add_generation_prompt=True
+            )
+            for messages in conversations
+        ]
+        
+        # Vision inputs of all conversations, in batch order
+        image_inputs, video_inputs = process_vision_info(conversations)
+        
+        inputs = self.processor(
+            text=texts,
+            images=image_inputs,
+            videos=video_inputs,
+            padding=True,
+            return_tensors="pt",
+        )
+        if self.vision_cache is not None:
+            self.vision_cache.set_inputs(inputs)
+        # Move inputs to device with correct dtype
+        return inputs.to(self.model.device, dtype=torch.float16)
+    
+    def _generate(self, inputs, max_new_tokens: int, temperature: float) -> List[str]:
+        """Generate for a batch from _build_inputs; returns one decoded string per request."""
+        with torch.inference_mode():
+            if temperature > 0:
+                generated_ids = self.model.generate(
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=True,
+                    temperature=temperature,
+                    use_cache=True,
+                    pad_token_id=self.processor.tokenizer.eos_token_id,
+                )
+            else:
+                generated_ids = self.model.generate(
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=False,
+                    use_cache=True,
+                    pad_token_id=self.processor.tokenizer.eos_token_id,
+                )
+            
+            # Prompts are left-padded to a common length, so new tokens start at the same offset
+            generated_ids_trimmed = generated_ids[:, inputs.input_ids.shape[1]:]
+        
+        output_texts = self.processor.batch_decode(
+            generated_ids_trimmed, 
+            skip_special_tokens=True, 
+            clean_up_tokenization_spaces=False
+        )
+        return [text.strip() for text in output_texts]
+    
     def generate_response(self, 
                          text_input: str, 
                          image_paths: Optional[List[str]] = None,
@@ -226,93 +320,47 @@ class WisWheat_GwenService:
                          do_sample: bool = True,
                          upload_folder: Optional[str] = None) -> str:
         
-        # Apply hardcoded max_new_tokens for 3b model (keeping existing behavior)
-        if self.model_size == "3b":
-            max_new_tokens = 2048  # TODO: Hardcoded for now
-        
+        request = {
+            "text_input": text_input,
+            "image_paths": image_paths,
+            "conversation_history": conversation_history,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature if do_sample else 0.0,
+            "upload_folder": upload_folder,
+        }
+        return self.generate_batch([request])[0]
+    
+    def generate_batch(self, requests: List[Dict[str, Any]]) -> List[str]:
+        """
+        Generate responses for several requests in a single batched forward pass.
+        Each request is a dict of generate_response keyword arguments; all of them
+        must share max_new_tokens and temperature.
+        """
         if not self.is_loaded:
             raise RuntimeError(f"WisWheat-Gwen-{self.model_size.upper()} model not loaded. Please call load_model() first.")
         
+        # The 3b model always runs to the cap, whatever was requested
+        if self.model_size == "3b":
+            max_new_tokens = self.MAX_NEW_TOKENS
+        else:
+            max_new_tokens = min(requests[0].get("max_new_tokens", 512), self.MAX_NEW_TOKENS)
+        temperature = requests[0].get("temperature", 0.7)
+        
         try:
             # Clear cache before processing
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
             
-            messages, _ = self._create_messages(text_input, image_paths, conversation_history, include_system_prompt=False, upload_folder=upload_folder)
-            
-            # Apply chat template to get text
-            text = self.processor.apply_chat_template(
-                messages, 
-                tokenize=False, 
-                add_generation_prompt=True
-            )
-            
-            # Process vision information
-            image_inputs, video_inputs = process_vision_info(messages)
-            
-            # Prepare inputs with memory-efficient settings
-            inputs = self.processor(
-                text=[text],
-                images=image_inputs,
-                videos=video_inputs,
-                padding=True,
-                return_tensors="pt",
-            )
-            
-            # Move inputs to device with correct dtype
-            inputs = inputs.to(self.model.device, dtype=torch.float16)
-            
-            # Generate response with memory optimizations
-            with torch.inference_mode():
-                # Reduce max_new_tokens further if needed
-                effective_max_tokens = min(max_new_tokens, 256)
-                
-                if do_sample and temperature > 0:
-                    generated_ids = self.model.generate(
-                        **inputs,
-                        max_new_tokens=effective_max_tokens,
-                        do_sample=True,
-                        temperature=temperature,
-                        use_cache=True,
-                        pad_token_id=self.processor.tokenizer.eos_token_id,
-                    )
-                else:
-                    generated_ids = self.model.generate(
-                        **inputs,
-                        max_new_tokens=effective_max_tokens,
-                        do_sample=False,
-                        use_cache=True,
-                        pad_token_id=self.processor.tokenizer.eos_token_id,
-                    )
-                
-                # Extract only the new tokens
-                generated_ids_trimmed = [
-                    out_ids[len(in_ids):] 
-                    for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-                ]
-            
-            # Decode the response
-            output_text = self.processor.batch_decode(
-                generated_ids_trimmed, 
-                skip_special_tokens=True, 
-                clean_up_tokenization_spaces=False
-            )
-            
-            # No cleanup needed - images processed in memory
-            
-            # Clear cache after processing
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            
-            # Return the first (and should be only) response
-            return output_text[0].strip() if output_text else ""
+            inputs = self._build_inputs(requests)
+            return self._generate(inputs, max_new_tokens, temperature)
             
         except Exception as e:
             logger.error(f"Error during WisWheat-Gwen-{self.model_size.upper()} response generation: {str(e)}")
-            # Clear cache on error
+            raise
+        finally:
+            # Clear cache after processing, and on error
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
-            raise
     
     def generate_response_stream(self, 
                                text_input: str, 
@@ -346,6 +394,8 @@ class WisWheat_GwenService:
                 padding=True,
                 return_tensors="pt",
             )
+            if self.vision_cache is not None:
+                self.vision_cache.set_inputs(inputs)
             # Fix data type mismatch - use correct dtype when moving to device
             inputs = inputs.to(self.device, dtype=torch.float16)
             
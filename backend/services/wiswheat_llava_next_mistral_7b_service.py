@@ -2,6 +2,7 @@ import os
 import torch
 import gc
 import logging
+from functools import partial
 from typing import List, Optional, Dict, Any, Iterator
 from transformers import LlavaNextProcessor, LlavaNextForConditionalGeneration, TextIteratorStreamer
 
@@ -17,12 +18,15 @@ if hasattr(torch, 'compiler') and not hasattr(torch.compiler, 'is_compiling'):
 from PIL import Image
 from threading import Thread
 from utils.common import preprocess_image_in_memory
+from utils.model_cache import load_cached_processor
 
 logger = logging.getLogger(__name__)
 
 class WisWheat_LLavaNext_Mistral_7BService:
+    MODEL_NAME = "llava-hf/llava-v1.6-mistral-7b-hf"
+    
     def __init__(self, device_map: str = "auto"):
-        self.model_name = "llava-hf/llava-v1.6-mistral-7b-hf"
+        self.model_name = self.MODEL_NAME
         self.device_map = device_map
         self.model = None
         self.processor = None
@@ -38,6 +42,15 @@ class WisWheat_LLavaNext_Mistral_7BService:
         self.max_pixels = 1280 * 28 * 28
         self.max_images_per_request = 10    # Maximum number of images per request
         
+    @staticmethod
+    def create_processor(model_name):
+        return LlavaNextProcessor.from_pretrained(model_name)
+    
+    @classmethod
+    def processor_factory(cls, **service_kwargs):
+        """Model name and processor factory, without constructing the service (see Qwen2_5_7BService)"""
+        return cls.MODEL_NAME, partial(cls.create_processor, cls.MODEL_NAME)
+
     def load_model(self) -> bool:
         if self.is_loaded:
             logger.info("WisWheat-LLavaNext-Mistral-7B model already loaded")
@@ -53,8 +66,7 @@ class WisWheat_LLavaNext_Mistral_7BService:
                 low_cpu_mem_usage=True,
             )
             
-            self.processor = LlavaNextProcessor.from_pretrained(
-                self.model_name)
+            self.processor = load_cached_processor(self.model_name, partial(self.create_processor, self.model_name))
             
             self.is_loaded = True
             logger.info(f"WisWheat-LLavaNext-Mistral-7B model loaded successfully with memory optimizations.")
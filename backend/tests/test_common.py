@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+from PIL import Image, ImageChops
+from utils.common import PREPARED_IMAGE_SIZE, prepare_image, prepared_image_path, preprocess_image_in_memory
+
+
+class PrepareImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def _save(self, name, size, mode='RGB'):
+        path = os.path.join(self.tmpdir.name, name)
+        img = Image.linear_gradient('L').resize(size).convert(mode)
+        img.save(path)
+        return path
+
+    def test_small_rgb_image_gets_no_sidecar(self):
+        path = self._save('small.png', (64, 48))
+        self.assertFalse(prepare_image(path))
+        self.assertFalse(os.path.exists(prepared_image_path(path)))
+
+    def test_sidecar_has_the_same_pixels(self):
+        size = (PREPARED_IMAGE_SIZE[0] * 2, PREPARED_IMAGE_SIZE[1])
+        path = self._save('large.png', size)
+        expected = preprocess_image_in_memory(path)
+        
+        self.assertTrue(prepare_image(path))
+        self.assertTrue(os.path.exists(prepared_image_path(path)))
+        actual = preprocess_image_in_memory(path)
+        self.assertEqual(actual.size, expected.size)
+        self.assertIsNone(ImageChops.difference(actual, expected).getbbox())
+
+    def test_mode_conversion_gets_a_sidecar(self):
+        path = self._save('gray.png', (64, 48), mode='L')
+        self.assertTrue(prepare_image(path))
+        with Image.open(prepared_image_path(path)) as img:
+            self.assertEqual(img.mode, 'RGB')
@@ -0,0 +1,83 @@
+import os
+import json
+import tempfile
+import unittest
+from flask import Flask
+from models import db
+from models.model import ChatSession, ChatMessage
+
+
+class ContentHashTest(unittest.TestCase):
+
+    def test_batch_hashes_match_generate_content_hash(self):
+        items = [
+            ('session-1', 'user', 'hello'),
+            ('session-1', 'assistant', 'héllo, wörld'),
+            ('session-2', 'user', ''),
+        ]
+        self.assertEqual(
+            ChatMessage.batch_generate_content_hashes(items),
+            [ChatMessage.generate_content_hash(*item) for item in items],
+        )
+
+    def test_batch_hashes_of_nothing(self):
+        self.assertEqual(ChatMessage.batch_generate_content_hashes(iter([])), [])
+
+
+
+class BulkCreateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(self.tmpdir.name, 'test.db')}"
+        db.init_app(self.app)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        session = ChatSession(name='import', model_id='test')
+        db.session.add(session)
+        db.session.commit()
+        self.session_id = session.id
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        self.ctx.pop()
+        self.tmpdir.cleanup()
+
+    def test_imported_conversation_keeps_its_order(self):
+        turns = [('user', 'q1'), ('assistant', 'a1'), ('user', 'q2'), ('assistant', 'a2'),
+                 ('user', 'q3'), ('assistant', 'a3'), ('user', 'q4')]
+        ids = ChatMessage.bulk_create(
+            [{'session_id': self.session_id, 'message_type': t, 'content': c} for t, c in turns],
+            page_size=3,
+        )
+        db.session.commit()
+        
+        messages = ChatMessage.dicts_for_session(self.session_id)
+        self.assertEqual([m['id'] for m in messages], ids)
+        self.assertEqual([(m['message_type'], m['content']) for m in messages], turns)
+        
+        history = ChatMessage.get_conversation_history(self.session_id, limit_pairs=2, exclude_latest_user=True)
+        self.assertEqual([(user.content, assistant.content) for user, assistant in history],
+                         [('q2', 'a2'), ('q3', 'a3')])
+        
+        self.assertEqual(db.session.get(ChatSession, self.session_id).message_count, len(turns))
+        self.assertEqual(ChatMessage.query.filter_by(content='a1').one().content_hash,
+                         ChatMessage.generate_content_hash(self.session_id, 'assistant', 'a1'))
+
+    
+    def test_references_image(self):
+        ChatMessage.bulk_create([{'session_id': self.session_id, 'message_type': 'user', 'content': 'look',
+                                  'images': json.dumps(['a.jpg', 'b_1.png'])}])
+        db.session.commit()
+        
+        self.assertTrue(ChatMessage.references_image('a.jpg'))
+        self.assertTrue(ChatMessage.references_image('b_1.png'))
+        self.assertFalse(ChatMessage.references_image('a.jp'))
+        self.assertFalse(ChatMessage.references_image('b%1.png'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import threading
+import unittest
+from utils.streaming import iterate_in_thread, iterate_in_thread_batches
+
+
+class IterateInThreadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+
+    def test_yields_all_items_in_order(self):
+        self.assertEqual(list(iterate_in_thread(self.lock, lambda: iter(range(5)))), [0, 1, 2, 3, 4])
+
+    def test_batches_respect_max_batch(self):
+        # The producer finishes before the first get, so every batch is full except the last
+        done = threading.Event()
+        
+        def produce():
+            yield from range(5)
+            done.set()
+        
+        def submit(fn):
+            fn()
+        
+        batches = list(iterate_in_thread_batches(self.lock, produce, submit=submit, max_batch=2, max_delay=1))
+        self.assertTrue(done.is_set())
+        self.assertEqual(batches, [[0, 1], [2, 3], [4]])
+
+    def test_producer_error_is_reraised_and_lock_released(self):
+        def produce():
+            yield 1
+            raise ValueError('boom')
+        
+        items = iterate_in_thread(self.lock, produce)
+        self.assertEqual(next(items), 1)
+        with self.assertRaises(ValueError):
+            next(items)
+        self.assertTrue(self.lock.acquire(timeout=1))
+        self.lock.release()
+
+    def test_close_stops_the_producer(self):
+        produced = []
+        closed = threading.Event()
+        resume = threading.Event()
+        
+        def produce():
+            try:
+                for i in range(100):
+                    produced.append(i)
+                    yield i
+                    resume.wait(1)
+            finally:
+                closed.set()
+        
+        items = iterate_in_thread(self.lock, produce)
+        self.assertEqual(next(items), 0)
+        items.close()
+        resume.set()
+        self.assertTrue(closed.wait(1))
+        self.assertLess(len(produced), 100)
+        self.assertTrue(self.lock.acquire(timeout=1))
+        self.lock.release()
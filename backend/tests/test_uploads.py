@@ -0,0 +1,42 @@
+import os
+import tempfile
+import unittest
+from app import uploads
+from app.uploads import create_upload_file, publish_upload_file
+
+
+class PublishUploadFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def _publish(self, name, data):
+        file, tmp_path = create_upload_file(self.tmpdir.name)
+        file.write(data)
+        final_path = os.path.join(self.tmpdir.name, name)
+        publish_upload_file(file, tmp_path, final_path)
+        return tmp_path, final_path
+
+    def test_published_file_exists(self):
+        tmp_path, final_path = self._publish('a.jpg', b'image bytes')
+        with open(final_path, 'rb') as f:
+            self.assertEqual(f.read(), b'image bytes')
+        self.assertEqual(os.listdir(self.tmpdir.name), ['a.jpg'])
+
+    @unittest.skipUnless(uploads._O_TMPFILE is not None, 'O_TMPFILE not available')
+    def test_tmpfile_is_linked_not_copied(self):
+        tmp_path, final_path = self._publish('a.jpg', b'first')
+        self.assertIsNone(tmp_path)
+        self.assertTrue(uploads._use_tmpfile)
+        
+        # Publishing over an existing name replaces it
+        tmp_path, final_path = self._publish('a.jpg', b'second')
+        self.assertIsNone(tmp_path)
+        with open(final_path, 'rb') as f:
+            self.assertEqual(f.read(), b'second')
+        self.assertEqual(os.listdir(self.tmpdir.name), ['a.jpg'])
+
+
+if __name__ == '__main__':
+    unittest.main()
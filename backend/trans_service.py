@@ -4,10 +4,10 @@ import os
 import torch
 import gc
 import logging
-from typing import Optional, Dict, Any, Union
+import numpy as np
+from typing import Optional, Dict, Any, Union, BinaryIO, Iterator
 from transformers import pipeline
 from pydub import AudioSegment
-import tempfile
 import uuid
 
 logging.basicConfig(
@@ -16,8 +16,25 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+DEFAULT_MODEL_NAME = "openai/whisper-large-v3-turbo"
+# Streamed transcription works through the audio in windows of Whisper's native 30s input
+STREAM_WINDOW_MS = 30 * 1000
+
+def drop_page_cache(path: str) -> None:
+    """Tell the kernel a file's cached pages won't be read again (no-op without posix_fadvise)"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.debug(f"Could not drop page cache for {path}: {e}")
+
 class WhisperTranscriptionService:
-    def __init__(self, model_name: str = "openai/whisper-large-v3-turbo"):
+    def __init__(self, model_name: str = DEFAULT_MODEL_NAME):
         self.model_name = model_name
         self.pipeline = None
         self.is_loaded = False
@@ -64,25 +81,60 @@ class WhisperTranscriptionService:
     def unload_model(self):
         self._cleanup()
     
+    def _export_mp3(self, audio: AudioSegment, output_dir: str, original_name: str) -> str:
+        unique_id = str(uuid.uuid4())
+        mp3_filename = f"{unique_id}_{original_name}.mp3"
+        mp3_path = os.path.join(output_dir, mp3_filename)
+        
+        audio.export(mp3_path, format="mp3")
+        
+        logger.info(f"Audio converted successfully to: {mp3_path}")
+        return mp3_path
+    
     def convert_audio_to_mp3(self, input_file_path: str, output_dir: str) -> str:
         try:
             logger.info(f"Converting audio file: {input_file_path}")
             
-            unique_id = str(uuid.uuid4())
             original_name = os.path.splitext(os.path.basename(input_file_path))[0]
-            mp3_filename = f"{unique_id}_{original_name}.mp3"
-            mp3_path = os.path.join(output_dir, mp3_filename)
-            
             audio = AudioSegment.from_file(input_file_path)
-            audio.export(mp3_path, format="mp3")
-            
-            logger.info(f"Audio converted successfully to: {mp3_path}")
-            return mp3_path
+            return self._export_mp3(audio, output_dir, original_name)
             
         except Exception as e:
             logger.error(f"Failed to convert audio file: {str(e)}")
             raise
     
+    def _pipeline_input(self, audio: AudioSegment) -> Dict[str, Any]:
+        """Decoded audio as the mono float32 samples the pipeline expects, so no temp file is needed"""
+        sampling_rate = self.pipeline.feature_extractor.sampling_rate
+        audio = audio.set_channels(1).set_frame_rate(sampling_rate)
+        samples = np.array(audio.get_array_of_samples(), dtype=np.float32)
+        samples /= float(1 << (8 * audio.sample_width - 1))
+        return {"raw": samples, "sampling_rate": sampling_rate}
+    
+    def _transcribe_segment(self,
+                            audio: AudioSegment,
+                            return_timestamps: bool = False,
+                            batch_size: int = 8) -> Dict[str, Any]:
+        if return_timestamps:
+            result = self.pipeline(
+                self._pipeline_input(audio), 
+                batch_size=batch_size, 
+                return_timestamps=True
+            )
+            transcription = {
+                "text": result.get("text", ""),
+                "chunks": result.get("chunks", [])
+            }
+        else:
+            result = self.pipeline(self._pipeline_input(audio), batch_size=batch_size)
+            transcription = {
+                "text": result.get("text", ""),
+                "chunks": None
+            }
+        
+        logger.info(f"Transcription completed successfully")
+        return transcription
+    
     def transcribe_audio(self, 
                         audio_file_path: str,
                         return_timestamps: bool = False,
@@ -103,50 +155,23 @@ class WhisperTranscriptionService:
                 raise FileNotFoundError(f"Audio file not found: {audio_file_path}")
             
             audio = AudioSegment.from_file(audio_file_path)
-            
-            # Export to mp3 temp file
-            with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as temp_file:
-                audio.export(temp_file.name, format="mp3")
-                temp_path = temp_file.name
-            
-            try:
-                if return_timestamps:
-                    result = self.pipeline(
-                        temp_path, 
-                        batch_size=batch_size, 
-                        return_timestamps=True
-                    )
-                    transcription = {
-                        "text": result.get("text", ""),
-                        "chunks": result.get("chunks", [])
-                    }
-                else:
-                    result = self.pipeline(temp_path, batch_size=batch_size)
-                    transcription = {
-                        "text": result.get("text", ""),
-                        "chunks": None
-                    }
-                
-                logger.info(f"Transcription completed successfully")
-                return transcription
-                
-            finally:
-                # Clean up temporary file
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
+            return self._transcribe_segment(audio, return_timestamps=return_timestamps, batch_size=batch_size)
             
         except Exception as e:
             logger.error(f"Error during transcription: {str(e)}")
             raise
     
     def process_audio_file(self,
-                          input_file_path: str,
-                          output_dir: str,
+                          input_file_path: Optional[str] = None,
+                          output_dir: str = None,
                           return_timestamps: bool = False,
                           batch_size: int = 8,
-                          keep_mp3: bool = True) -> Dict[str, Any]:
+                          keep_mp3: bool = True,
+                          input_stream: Optional[BinaryIO] = None,
+                          input_format: Optional[str] = None,
+                          input_name: Optional[str] = None) -> Dict[str, Any]:
         """
-        Complete workflow: convert audio file to MP3 and transcribe
+        Complete workflow: decode the audio once, transcribe it and optionally keep an MP3 copy
         
         Args:
             input_file_path: Path to input audio file
@@ -154,39 +179,94 @@ class WhisperTranscriptionService:
             return_timestamps: Whether to return timestamp information
             batch_size: Batch size for processing
             keep_mp3: Whether to keep the converted MP3 file
+            input_stream: File-like object to read the audio from instead of input_file_path
+            input_format: Container format of the input (e.g. 'wav'); probed by ffmpeg when None
+            input_name: Original file name, used to name the MP3 (defaults to the input file's name)
         
         Returns:
             Dictionary containing transcription results and MP3 path
         """
+        if not self.is_loaded:
+            raise RuntimeError("Model not loaded.")
+        
         try:
-            mp3_path = self.convert_audio_to_mp3(input_file_path, output_dir)
+            source = input_stream if input_stream is not None else input_file_path
+            audio = AudioSegment.from_file(source, format=input_format)
+            if input_stream is None:
+                # Decoded into memory; the (possibly large) source file is not read again
+                drop_page_cache(input_file_path)
+            original_name = os.path.splitext(input_name or os.path.basename(input_file_path or 'audio'))[0]
             
-            transcription = self.transcribe_audio(
-                mp3_path, 
+            transcription = self._transcribe_segment(
+                audio, 
                 return_timestamps=return_timestamps,
                 batch_size=batch_size
             )
             
-            result = {
+            # The MP3 is only a by-product for the client now, so skip it when not kept
+            mp3_path = self._export_mp3(audio, output_dir, original_name) if keep_mp3 else None
+            
+            return {
                 "transcription": transcription,
                 "mp3_path": mp3_path,
-                "mp3_filename": os.path.basename(mp3_path)
+                "mp3_filename": os.path.basename(mp3_path) if mp3_path else None
             }
             
-            if not keep_mp3:
-                try:
-                    os.unlink(mp3_path)
-                    result["mp3_path"] = None
-                    result["mp3_filename"] = None
-                except:
-                    logger.warning(f"Failed to remove temporary MP3 file: {mp3_path}")
-            
-            return result
-            
         except Exception as e:
             logger.error(f"Error processing audio file: {str(e)}")
             raise
     
+    def process_audio_file_stream(self,
+                                 input_file_path: str,
+                                 output_dir: str,
+                                 return_timestamps: bool = False,
+                                 batch_size: int = 8,
+                                 keep_mp3: bool = True) -> Iterator[Dict[str, Any]]:
+        """
+        Streaming variant of process_audio_file: transcribes STREAM_WINDOW_MS windows one at a time
+        
+        Yields:
+            {"type": "chunk", "text", "chunks", "start", "end"} per window (times in seconds from the
+            start of the file), then {"type": "done", "mp3_filename"}
+        """
+        if not self.is_loaded:
+            raise RuntimeError("Model not loaded.")
+        
+        audio = AudioSegment.from_file(input_file_path)
+        drop_page_cache(input_file_path)
+        original_name = os.path.splitext(os.path.basename(input_file_path))[0]
+        
+        for start_ms in range(0, len(audio), STREAM_WINDOW_MS):
+            window = audio[start_ms:start_ms + STREAM_WINDOW_MS]
+            transcription = self._transcribe_segment(
+                window,
+                return_timestamps=return_timestamps,
+                batch_size=batch_size
+            )
+            offset = start_ms / 1000
+            chunks = transcription["chunks"]
+            if chunks:
+                chunks = [
+                    {
+                        "text": chunk["text"],
+                        "timestamp": tuple(t + offset if t is not None else None for t in chunk["timestamp"])
+                    }
+                    for chunk in chunks
+                ]
+            yield {
+                "type": "chunk",
+                "text": transcription["text"],
+                "chunks": chunks,
+                "start": offset,
+                "end": offset + len(window) / 1000
+            }
+        
+        mp3_path = self._export_mp3(audio, output_dir, original_name) if keep_mp3 else None
+        yield {
+            "type": "done",
+            "mp3_filename": os.path.basename(mp3_path) if mp3_path else None
+        }
+    
     def is_model_loaded(self) -> bool:
         return self.is_loaded
     
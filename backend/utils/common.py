@@ -3,10 +3,45 @@
 import os
 import logging
 from PIL import Image
+from functools import lru_cache
 from typing import Tuple
 
 logger = logging.getLogger(__name__)
 
+# Uploads get a downsized RGB WebP copy next to them so generation skips decoding/resizing the original
+PREPARED_IMAGE_SIZE = (1024, 1024)
+PREPARED_IMAGE_SUFFIX = '.webp'
+
+# Decoded images kept in memory by preprocess_image_in_memory (~3MB each at 1024x1024)
+IMAGE_CACHE_SIZE = int(os.environ.get('IMAGE_CACHE_SIZE', 32))
+
+def prepared_image_path(image_path: str) -> str:
+    return image_path + PREPARED_IMAGE_SUFFIX
+
+def prepare_image(image_path: str) -> bool:
+    """Write the downsized sidecar for an uploaded image (called off the request path).
+    Returns whether a sidecar was written; images already RGB and within PREPARED_IMAGE_SIZE get none."""
+    prepared_path = prepared_image_path(image_path)
+    tmp_path = prepared_path + '.tmp'
+    try:
+        with Image.open(image_path) as img:
+            too_large = img.size[0] > PREPARED_IMAGE_SIZE[0] or img.size[1] > PREPARED_IMAGE_SIZE[1]
+            if img.mode == 'RGB' and not too_large:
+                return False
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            img.thumbnail(PREPARED_IMAGE_SIZE, Image.Resampling.LANCZOS)
+            # Lossless, so the model sees the same pixels with or without the sidecar
+            img.save(tmp_path, format='WEBP', lossless=True)
+        # Readers only ever see a complete sidecar
+        os.replace(tmp_path, prepared_path)
+        return True
+    except Exception as e:
+        logger.warning(f"Failed to prepare image {image_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
 def preprocess_image(image_path: str, max_image_size: Tuple[int, int] = (1024, 1024)) -> str:
     """Preprocess image to reduce memory usage (legacy function - kept for backward compatibility)"""
     try:
@@ -32,24 +67,36 @@ def preprocess_image(image_path: str, max_image_size: Tuple[int, int] = (1024, 1
         logger.warning(f"Failed to preprocess image {image_path}: {e}")
         return image_path
 
+@lru_cache(maxsize=IMAGE_CACHE_SIZE)
+def _load_image(image_path: str, mtime_ns: int, max_image_size: Tuple[int, int]) -> Image.Image:
+    """Decode, RGB-convert and downsize an image; cached per (path, mtime), so a rewritten file is decoded again"""
+    with Image.open(image_path) as img:
+        # Convert to RGB if necessary
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        
+        # Resize image if it's too large
+        if img.size[0] > max_image_size[0] or img.size[1] > max_image_size[1]:
+            # Create a copy since we're returning it
+            img = img.copy()
+            img.thumbnail(max_image_size, Image.Resampling.LANCZOS)
+            logger.info(f"Resized image from {image_path} to {img.size}")
+            return img
+        else:
+            # Return a copy to ensure the original file handle is closed
+            return img.copy()
+
 def preprocess_image_in_memory(image_path: str, max_image_size: Tuple[int, int] = (1024, 1024)) -> Image.Image:
     """Preprocess image in memory to avoid disk I/O"""
+    # The prepared sidecar is already RGB and at most PREPARED_IMAGE_SIZE
+    if max_image_size[0] <= PREPARED_IMAGE_SIZE[0] and max_image_size[1] <= PREPARED_IMAGE_SIZE[1]:
+        prepared_path = prepared_image_path(image_path)
+        if os.path.exists(prepared_path):
+            image_path = prepared_path
     try:
-        with Image.open(image_path) as img:
-            # Convert to RGB if necessary
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # Resize image if it's too large
-            if img.size[0] > max_image_size[0] or img.size[1] > max_image_size[1]:
-                # Create a copy since we're returning it
-                img = img.copy()
-                img.thumbnail(max_image_size, Image.Resampling.LANCZOS)
-                logger.info(f"Resized image from {image_path} to {img.size}")
-                return img
-            else:
-                # Return a copy to ensure the original file handle is closed
-                return img.copy()
+        # History images are sent again with every turn; a copy keeps the cached image unchanged
+        img = _load_image(image_path, os.stat(image_path).st_mtime_ns, tuple(max_image_size))
+        return img.copy()
     except Exception as e:
         logger.warning(f"Failed to preprocess image {image_path}: {e}")
         raise
\ No newline at end of file
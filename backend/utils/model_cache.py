@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import os
+import pickle
+import logging
+import tempfile
+from threading import Thread
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+# Pickled processors (tokenizer + image processor config), written by `python -m app.warm_cache`
+MODEL_META_CACHE_DIR = os.environ.get('MODEL_META_CACHE_DIR', '/opt/cache')
+
+# Processors loaded before workers fork (see preload_processor), shared copy-on-write
+_preloaded_processors = {}
+
+def _cache_path(model_name: str) -> str:
+    return os.path.join(MODEL_META_CACHE_DIR, model_name.replace('/', '--') + '.pkl')
+
+def save_processor(model_name: str, processor: Any) -> bool:
+    """Atomically write the pickled processor for model_name to the cache"""
+    try:
+        os.makedirs(MODEL_META_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=MODEL_META_CACHE_DIR, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(processor, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, _cache_path(model_name))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return True
+    except Exception as e:
+        logger.warning(f"Failed to cache processor for {model_name}: {e}")
+        return False
+
+def _refresh_processor(model_name: str, factory: Callable[[], Any]):
+    try:
+        save_processor(model_name, factory())
+        logger.info(f"Refreshed cached processor for {model_name}")
+    except Exception as e:
+        logger.warning(f"Failed to refresh cached processor for {model_name}: {e}")
+
+def load_cached_processor(model_name: str, factory: Callable[[], Any]) -> Any:
+    """
+    Return the processor for model_name from the pickle cache, skipping the hub round trips.
+    On a hit the cache is refreshed from the hub in the background (stale-while-revalidate);
+    on a miss the processor is built with factory() and cached for the next start.
+    """
+    if model_name in _preloaded_processors:
+        return _preloaded_processors[model_name]
+    
+    try:
+        with open(_cache_path(model_name), 'rb') as f:
+            processor = pickle.load(f)
+    except FileNotFoundError:
+        processor = factory()
+        save_processor(model_name, processor)
+        return processor
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable processor cache for {model_name}: {e}")
+        processor = factory()
+        save_processor(model_name, processor)
+        return processor
+
+    logger.info(f"Loaded processor for {model_name} from cache")
+    Thread(target=_refresh_processor, args=(model_name, factory), daemon=True).start()
+    return processor
+
+def preload_processor(model_name: str, factory: Callable[[], Any]):
+    """Load a processor in the gunicorn master so forked workers reuse it instead of loading their own"""
+    _preloaded_processors[model_name] = load_cached_processor(model_name, factory)
+    logger.info(f"Preloaded processor for {model_name}")
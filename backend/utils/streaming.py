@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import time
+import queue
+import logging
+from threading import Event, Thread
+from typing import Any, Callable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Queue items ending a stream, see iterate_in_thread_batches
+_STREAM_END = object()
+
+class _StreamError:
+    def __init__(self, error):
+        self.error = error
+
+def _start_thread(fn):
+    Thread(target=fn, daemon=True).start()
+
+def iterate_in_thread_batches(lock, make_iter: Callable[[], Iterator[Any]],
+                              submit: Optional[Callable] = None,
+                              max_batch: int = 1, max_delay: float = 0) -> Iterator[List[Any]]:
+    """
+    Run make_iter() under lock on another thread (submit(fn), a daemon Thread by default) and yield
+    its items in lists of up to max_batch, each waiting at most max_delay seconds for more items.
+    Items are handed over through a queue, so the lock is released as soon as the producer ends,
+    however slowly the caller consumes them. Closing this generator stops the producer at the next
+    item; a producer error is re-raised here.
+    """
+    # Unbounded: a bounded put would block while holding the lock
+    items = queue.Queue()
+    stop = Event()
+    
+    def produce():
+        try:
+            with lock:
+                inner = make_iter()
+                try:
+                    for item in inner:
+                        if stop.is_set():
+                            break
+                        items.put(item)
+                finally:
+                    # Runs the inner generator's cleanup now rather than at GC time
+                    close = getattr(inner, 'close', None)
+                    if close is not None:
+                        close()
+            items.put(_STREAM_END)
+        except Exception as e:
+            logger.error(f"Error in streamed producer: {e}")
+            items.put(_StreamError(e))
+    
+    (submit or _start_thread)(produce)
+    try:
+        while True:
+            item = items.get()
+            deadline = time.monotonic() + max_delay
+            batch = []
+            while item is not _STREAM_END and not isinstance(item, _StreamError):
+                batch.append(item)
+                item = None
+                if len(batch) >= max_batch:
+                    break
+                try:
+                    item = items.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if batch:
+                yield batch
+            if item is _STREAM_END:
+                return
+            if isinstance(item, _StreamError):
+                raise item.error
+    finally:
+        stop.set()
+
+def iterate_in_thread(lock, make_iter: Callable[[], Iterator[Any]], submit: Optional[Callable] = None) -> Iterator[Any]:
+    """iterate_in_thread_batches, one item at a time"""
+    batches = iterate_in_thread_batches(lock, make_iter, submit=submit)
+    try:
+        for batch in batches:
+            yield from batch
+    finally:
+        batches.close()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import os
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Optional
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Number of per-image vision tower outputs kept on the model device (~10MB each for a 7B model)
+VISION_CACHE_SIZE = int(os.environ.get('VISION_CACHE_SIZE', 32))
+
+class VisionEmbeddingCache:
+    """
+    LRU cache of vision tower outputs per image for Qwen2.5-VL models.
+    Wraps model.visual.forward; call set_inputs() with the processor output (still on CPU)
+    before generate() so the next vision forward can reuse embeddings of images seen before.
+    """
+
+    def __init__(self, visual, maxsize: int = VISION_CACHE_SIZE):
+        self.visual = visual
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._pending_keys = None
+        self._forward = visual.forward
+        visual.forward = self._cached_forward
+
+    @classmethod
+    def attach(cls, model, maxsize: int = VISION_CACHE_SIZE) -> Optional['VisionEmbeddingCache']:
+        """Attach a cache to model's vision tower, or return None if the model doesn't have one we understand"""
+        visual = getattr(model, 'visual', None)
+        if maxsize <= 0 or visual is None or not hasattr(visual, 'spatial_merge_size'):
+            logger.info("Vision embedding cache not enabled for this model")
+            return None
+        return cls(visual, maxsize)
+
+    def set_inputs(self, inputs):
+        """Compute per-image cache keys from the processor output, before it is moved to the device"""
+        pixel_values = inputs.get('pixel_values')
+        grid_thw = inputs.get('image_grid_thw')
+        if pixel_values is None or grid_thw is None:
+            self._pending_keys = None
+            return
+
+        keys = []
+        offset = 0
+        for grid in grid_thw.tolist():
+            count = grid[0] * grid[1] * grid[2]
+            patches = pixel_values[offset:offset + count].contiguous()
+            keys.append((tuple(grid), hashlib.sha1(patches.numpy().tobytes()).hexdigest()))
+            offset += count
+        self._pending_keys = keys
+
+    def clear(self):
+        self._cache.clear()
+        self._pending_keys = None
+
+    def _cached_forward(self, hidden_states, grid_thw, **kwargs):
+        # Keys only apply to the first vision forward after set_inputs (the prefill)
+        keys, self._pending_keys = self._pending_keys, None
+        if keys is None or len(keys) != grid_thw.shape[0]:
+            return self._forward(hidden_states, grid_thw, **kwargs)
+
+        patch_counts = grid_thw.prod(-1).tolist()
+        if sum(patch_counts) != hidden_states.shape[0]:
+            return self._forward(hidden_states, grid_thw, **kwargs)
+        merge_factor = self.visual.spatial_merge_size ** 2
+
+        offsets = [0]
+        for count in patch_counts:
+            offsets.append(offsets[-1] + count)
+
+        embeds = {key: self._cache[key] for key in keys if key in self._cache}
+        missing = [i for i, key in enumerate(keys) if key not in embeds]
+        if missing:
+            # Run the vision tower only on images not seen before
+            states = torch.cat([hidden_states[offsets[i]:offsets[i + 1]] for i in missing])
+            outputs = self._forward(states, grid_thw[missing], **kwargs)
+            out_offset = 0
+            for i in missing:
+                count = patch_counts[i] // merge_factor
+                embeds[keys[i]] = outputs[out_offset:out_offset + count].detach()
+                out_offset += count
+            logger.info(f"Vision cache: {len(keys) - len(missing)} hit(s), {len(missing)} miss(es)")
+
+        for key in keys:
+            self._cache[key] = embeds[key]
+            self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+        return torch.cat([embeds[key] for key in keys])
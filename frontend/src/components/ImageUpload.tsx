@@ -61,7 +61,7 @@ export const ImageUpload: React.FC<ImageUploadProps> = ({
       const updatedImages = newImages.map((img, index) => ({
         ...img,
         isUploading: false,
-        uploadedPath: response.files[index]?.path,
+        uploadedPath: response.paths[index],
       }));
       onImageUpload(updatedImages);
     } catch (error) {
@@ -133,6 +133,9 @@ class ApiService {
                 case 'token':
                   onToken(data.content);
                   break;
+                case 'tokens':
+                  onToken(data.content.join(''));
+                  break;
                 case 'done':
                   onDone?.();
                   return;
@@ -36,16 +36,14 @@ export interface AppState {
 }
 
 // API Types
-export interface UploadedFile {
-  original_name: string;
-  saved_name: string;
-  path: string;
-}
-
+// Parallel arrays, one entry per stored file
 export interface UploadResponse {
   status: string;
   message: string;
-  files: UploadedFile[];
+  count: number;
+  original_names: string[];
+  saved_names: string[];
+  paths: string[];
 }
 
 export interface GenerateRequest {